@@ -0,0 +1,48 @@
+'''Mock ansible module with default moira_trigger params'''
+
+DEFAULT_PARAMS = {
+    'api_url': 'http://moira/api/',
+    'login': None,
+    'auth_user': None,
+    'auth_pass': None,
+    'state': 'present',
+    'snapshot': None,
+    'profile': None,
+    'cache_dir': None,
+    'breaker_threshold': 0,
+    'breaker_timeout': 60,
+    'cache_window': 0,
+    'matrix': None,
+    'result_format': 'full',
+    'result_file': None,
+    'validate': True,
+    'name_ids': False,
+    'id_namespace': '4b1ffd8c-8f0e-5d3b-9a3e-6d6f69726121',
+    'migrate_ids': False,
+    'name': None,
+    'desc': '',
+    'ttl': None,
+    'ttl_state': None,
+    'expression': '',
+    'disabled_days': {},
+    'targets': None,
+    'tags': [],
+    'warn_value': None,
+    'error_value': None}
+
+
+class StubModule(object):
+
+    '''Mock ansible.module_utils.basic.AnsibleModule
+
+    Attributes:
+        params (dict): module params.
+        check_mode (bool): check mode flag.
+
+    '''
+
+    def __init__(self, check_mode=False, **params):
+
+        self.params = dict(DEFAULT_PARAMS)
+        self.params.update(params)
+        self.check_mode = check_mode
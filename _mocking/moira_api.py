@@ -83,6 +83,43 @@ class _Trigger(object):
         methods_calls.trace += '.create'
         return trigger_body
 
+class _TagStats(object):
+
+    '''Mock tag stats'''
+
+    def __init__(self,
+                 name=None,
+                 triggers=None):
+
+        self.name = name
+        self.triggers = triggers
+
+
+class _Tag(object):
+
+    '''Mock api methods'''
+
+    @staticmethod
+    def stats():
+
+        '''Mock moira.tag.stats'''
+
+        all_tags = []
+        if trigger_body.id is not None:
+            for tag_name in trigger_body.tags or []:
+                all_tags.append(_TagStats(tag_name, [trigger_body.id]))
+        methods_calls.trace += '.stats'
+        return all_tags
+
+    @staticmethod
+    def delete(tag_name):
+
+        '''Mock moira.tag.delete'''
+
+        methods_calls.trace += '.tag_delete'
+        return True
+
 methods_calls = _MethodsCalls()
 trigger_body = _TriggerBody()
-trigger = _Trigger()
\ No newline at end of file
+trigger = _Trigger()
+tag = _Tag()
\ No newline at end of file
@@ -0,0 +1,244 @@
+'''Stateful in-memory Moira api
+
+Moira api is faked at the HTTP client level: managers and models of
+moira_client make requests exactly as they do against real Moira,
+so recorded requests reflect real traffic.
+
+'''
+
+import copy
+import time
+import uuid
+
+try:
+    from moira_client.models.tag import TagManager
+    from moira_client.models.trigger import TriggerManager
+    from requests import HTTPError, Response
+    HAS_MOIRA_CLIENT = True
+except ImportError:
+    HAS_MOIRA_CLIENT = False
+
+DAYS = 'Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun'
+
+
+def _not_found(path):
+
+    '''HTTP 404 error as raised by moira_client.client.Client'''
+
+    response = Response()
+    response.status_code = 404
+    return HTTPError('404 Client Error: Not Found for url: ' + path,
+                     response=response)
+
+
+def _server_error(path):
+
+    '''HTTP 500 error as raised by moira_client.client.Client'''
+
+    response = Response()
+    response.status_code = 500
+    return HTTPError('500 Server Error: Internal Server Error for url: ' +
+                     path, response=response)
+
+
+def _endpoint(method, path):
+
+    '''Request name with object ids replaced by placeholders'''
+
+    parts = path.split('/')
+    if len(parts) > 1 and parts[0] == 'trigger':
+        parts[1] = '{id}'
+    elif len(parts) > 1 and parts[0] == 'tag' and parts[1] != 'stats':
+        parts[1] = '{name}'
+    return method + ' ' + '/'.join(parts)
+
+
+class CallLog(object):
+
+    '''Per-endpoint requests statistics
+
+    Attributes:
+        counts (dict): number of requests per endpoint.
+        timings (dict): request durations per endpoint.
+
+    '''
+
+    def __init__(self):
+
+        self.counts = {}
+        self.timings = {}
+
+    def record(self, endpoint, elapsed):
+
+        '''Save endpoint request'''
+
+        self.counts[endpoint] = self.counts.get(endpoint, 0) + 1
+        self.timings.setdefault(endpoint, []).append(elapsed)
+
+    def requests(self):
+
+        '''Number of requests to Moira api'''
+
+        return sum(self.counts.values())
+
+    def reset(self):
+
+        '''Forget recorded requests'''
+
+        self.counts.clear()
+        self.timings.clear()
+
+
+class FakeClient(object):
+
+    '''Mock moira_client.client.Client'''
+
+    def __init__(self, moira):
+
+        self._moira = moira
+
+    def _request(self, method, path, handler, *args):
+
+        '''Record request and build response'''
+
+        started = time.time()
+        if self._moira.latency:
+            time.sleep(self._moira.latency)
+        try:
+            return handler(path.split('/'), *args)
+        finally:
+            self._moira.calls.record(
+                _endpoint(method, path), time.time() - started)
+
+    def get(self, path='', **kwargs):
+
+        '''Mock moira_client.client.Client.get'''
+
+        return self._request('GET', path, self._moira.get)
+
+    def put(self, path='', **kwargs):
+
+        '''Mock moira_client.client.Client.put'''
+
+        return self._request('PUT', path, self._moira.put, kwargs['json'])
+
+    def delete(self, path='', **kwargs):
+
+        '''Mock moira_client.client.Client.delete'''
+
+        return self._request('DELETE', path, self._moira.delete)
+
+
+class FakeMoira(object):
+
+    '''Mock moira_client.Moira holding any number of triggers and tags
+
+    Attributes:
+        triggers (dict): trigger bodies by trigger id.
+        tags (set): tag names.
+        calls (class): recorded api requests.
+        latency (float): delay of every api request in seconds.
+        failing (set): names of triggers which can not be saved.
+        trigger (class): moira_client trigger manager.
+        tag (class): moira_client tag manager.
+
+    '''
+
+    def __init__(self, latency=0.0):
+
+        self.triggers = {}
+        self.tags = set()
+        self.calls = CallLog()
+        self.latency = latency
+        self.failing = set()
+        client = FakeClient(self)
+        self.trigger = TriggerManager(client)
+        self.tag = TagManager(client)
+
+    def get(self, parts):
+
+        '''Response to GET request'''
+
+        if parts == ['trigger']:
+            return {'list': [copy.deepcopy(body)
+                             for body in self.triggers.values()]}
+
+        if parts[0] == 'trigger':
+            if parts[1] not in self.triggers:
+                raise _not_found('/'.join(parts))
+            if parts[2:] == ['state']:
+                return {'trigger_id': parts[1], 'state': 'OK'}
+            return copy.deepcopy(self.triggers[parts[1]])
+
+        if parts == ['tag', 'stats']:
+            triggers = dict((tag, []) for tag in self.tags)
+            for trigger_id, body in self.triggers.items():
+                for tag in body.get('tags') or []:
+                    triggers.setdefault(tag, []).append(trigger_id)
+            return {'list': [
+                {'name': tag, 'triggers': tag_triggers, 'subscriptions': []}
+                for tag, tag_triggers in sorted(triggers.items())]}
+
+        if parts == ['tag']:
+            return {'list': sorted(self.tags)}
+
+        return {'list': []}
+
+    def put(self, parts, body):
+
+        '''Response to PUT request'''
+
+        if body.get('name') in self.failing:
+            raise _server_error('/'.join(parts))
+
+        body = copy.deepcopy(body)
+        trigger_id = parts[1] if len(parts) > 1 else body.get('id')
+
+        if trigger_id is None:
+            trigger_id = str(uuid.uuid4())
+
+        body['id'] = trigger_id
+        self.triggers[trigger_id] = body
+        self.tags.update(body.get('tags') or [])
+        return {'id': trigger_id, 'message': 'trigger saved'}
+
+    def delete(self, parts):
+
+        '''Response to DELETE request'''
+
+        if parts[0] == 'trigger':
+            self.triggers.pop(parts[1], None)
+        elif parts[0] == 'tag':
+            self.tags.discard(parts[1])
+        return {}
+
+    def seed(self, triggers, tags=()):
+
+        '''Add triggers and tags without recording requests
+
+        Returns:
+            List of created trigger ids.
+
+        '''
+
+        ids = []
+        for fields in triggers:
+            body = {
+                'desc': '',
+                'tags': [],
+                'warn_value': None,
+                'error_value': None,
+                'ttl': 600,
+                'ttl_state': 'NODATA',
+                'expression': ''}
+            body.update(fields)
+            disabled_days = body.pop('disabled_days', None) or ()
+            body['sched'] = {
+                'startOffset': 0,
+                'endOffset': 1439,
+                'tzOffset': 0,
+                'days': [{'name': day, 'enabled': day not in disabled_days}
+                         for day in DAYS]}
+            ids.append(self.put(['trigger'], body)['id'])
+        self.tags.update(tags)
+        return ids
@@ -1,9 +1,20 @@
 '''Test moira_trigger'''
 
+import json
+import os
+import shutil
+import tempfile
+import threading
 import unittest
+import uuid
 import warnings
 from _mocking import ansible_pkg, moira_api
-from moira_trigger import MoiraAnsible, HAS_MOIRA_CLIENT
+from _mocking.ansible_module import StubModule
+from _mocking.moira_fake import FakeMoira
+import moira_trigger
+from moira_trigger import MoiraAnsible, MoiraSnapshot, HAS_MOIRA_CLIENT, \
+    CircuitBreaker, Coordinator, TriggerValidator, LOCK_BUCKETS, \
+    expand_triggers, moira_run, profile_call
 
 test_trigger = {
     'name': 'test',
@@ -157,5 +168,1117 @@ class TestMoiraAnsible(unittest.TestCase):
         self.test_trigger_create()
 
 
+class TestMoiraSnapshot(unittest.TestCase):
+
+    '''Test check mode against a local snapshot'''
+
+    def setUp(self):
+
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'moira.snapshot.gz')
+        self.trigger = {
+            'name': test_trigger_name,
+            'targets': ['target1', 'target2'],
+            'desc': 'test desc',
+            'tags': ['tag1', 'tag2']}
+        moira_api.trigger_body.__dict__.update(self.trigger)
+        moira_api.trigger_body.id = 'gh0st'
+
+    def tearDown(self):
+
+        shutil.rmtree(self.tmp_dir)
+        moira_api.trigger_body.id = None
+        moira_api.methods_calls.trace = ''
+
+    def test_snapshot_export(self):
+
+        '''Export triggers and tags'''
+
+        exporter = MoiraAnsible(moira_api)
+        exporter.snapshot_export(self.path)
+
+        self.assertFalse(exporter.failed)
+        self.assertEqual(
+            exporter.success['snapshot exported'],
+            {'path': self.path, 'triggers': 1, 'tags': 2})
+        self.assertEqual(moira_api.methods_calls.trace,
+                         '.fetch_all.stats')
+
+    def test_snapshot_check_mode(self):
+
+        '''Compare triggers with snapshot offline'''
+
+        MoiraAnsible(moira_api).snapshot_export(self.path)
+        moira_api.methods_calls.trace = ''
+
+        snapshot = MoiraSnapshot.load(self.path)
+        self.assertEqual(
+            [tag.name for tag in snapshot.tag.stats()], ['tag1', 'tag2'])
+
+        offline = MoiraAnsible(snapshot, dry_run=True)
+        offline.trigger_customize(
+            dict(self.trigger, name='other'), 'absent')
+        offline.trigger_customize(
+            dict(self.trigger, desc='new desc'), 'present')
+
+        self.assertFalse(offline.failed)
+        self.assertTrue(offline.changed)
+        self.assertEqual(
+            offline.success,
+            {'other': 'no id found for trigger',
+             test_trigger_name: {'trigger changed': 'gh0st'}})
+        self.assertEqual(moira_api.methods_calls.trace, '')
+
+    def test_snapshot_export_failed(self):
+
+        '''Failed export keeps previous snapshot'''
+
+        MoiraAnsible(moira_api).snapshot_export(self.path)
+
+        broken = MoiraSnapshot()
+        broken.trigger.create(id='broken', name='broken', desc=object()).save()
+
+        with self.assertRaises(TypeError):
+            MoiraSnapshot.dump(broken, self.path)
+
+        self.assertEqual(os.listdir(self.tmp_dir), ['moira.snapshot.gz'])
+        self.assertEqual(
+            MoiraSnapshot.load(self.path).trigger.ids_by_name(),
+            {test_trigger_name: 'gh0st'})
+
+    def test_snapshot_name_index(self):
+
+        '''Triggers are found by name without scanning the snapshot'''
+
+        snapshot = MoiraSnapshot()
+        for number in range(3):
+            snapshot.trigger.create(
+                id=str(number), name='trigger' + str(number % 2)).save()
+        snapshot.trigger.fetch_all = None
+
+        offline = MoiraAnsible(snapshot, dry_run=True)
+        self.assertEqual(offline.get_trigger_id('trigger0'), '0')
+        self.assertEqual(offline.fetch_trigger_ids(),
+                         {'trigger0': '0', 'trigger1': '1'})
+
+        snapshot.trigger.delete('0')
+        renamed = snapshot.trigger.fetch_by_id('1')
+        renamed.name = 'renamed'
+        renamed.update()
+
+        self.assertEqual(offline.fetch_trigger_ids(),
+                         {'trigger0': '2', 'renamed': '1'})
+        self.assertIsNone(offline.get_trigger_id('trigger1'))
+        self.assertFalse(offline.failed)
+
+
+class TestProfile(unittest.TestCase):
+
+    '''Test profiling of module runs'''
+
+    def test_profile_call(self):
+
+        '''Profile data saved and summarized'''
+
+        tmp_dir = tempfile.mkdtemp()
+        path = os.path.join(tmp_dir, 'moira_trigger.prof')
+
+        try:
+            result, summary = profile_call(
+                path, sorted, [3, 1, 2])
+            self.assertTrue(os.path.isfile(path))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        self.assertEqual(result, [1, 2, 3])
+        self.assertEqual(summary['path'], path)
+        self.assertNotIn('error', summary)
+        self.assertTrue(any(
+            'sorted' in hot['function']
+            for hot in summary['functions']))
+
+
+class TestMatrix(unittest.TestCase):
+
+    '''Test trigger template expansion'''
+
+    def test_expand_triggers(self):
+
+        '''Every combination of axes values makes a trigger'''
+
+        triggers = expand_triggers({
+            'name': '$service rps in ${dc}',
+            'desc': 'rps of $service',
+            'targets': ['$dc.$service.{get,post}.rps'],
+            'tags': ['$service', 'rps'],
+            'ttl': '600'},
+            {'service': ['api', 'web'], 'dc': ['dc1', 'dc2', 'dc3']})
+
+        self.assertEqual(len(triggers), 6)
+        self.assertEqual(triggers[0], {
+            'name': 'api rps in dc1',
+            'desc': 'rps of api',
+            'targets': ['dc1.api.{get,post}.rps'],
+            'tags': ['api', 'rps'],
+            'ttl': '600'})
+        self.assertEqual(
+            len(set(trigger['name'] for trigger in triggers)), 6)
+
+    def test_expand_values(self):
+
+        '''Strings are substituted as is, other values are converted'''
+
+        server = u'\u0441\u0435\u0440\u0432\u0435\u0440'
+        host = u'\u0445\u043e\u0441\u0442'
+
+        triggers = expand_triggers(
+            {'name': u'$host ' + server, 'tags': [server]},
+            {'host': [1, host]})
+
+        self.assertEqual(
+            [trigger['name'] for trigger in triggers],
+            [u'1 ' + server, host + u' ' + server])
+        self.assertEqual(triggers[0]['tags'], [server])
+
+
+class TestResultFormat(unittest.TestCase):
+
+    '''Test module result formats'''
+
+    def setUp(self):
+
+        self.moira_ansible = MoiraAnsible(moira_api)
+        self.moira_ansible.success.update({
+            'created': {'new trigger created': 'id1'},
+            'changed': {'trigger changed': 'id2'},
+            'unchanged': {'trigger unchanged': 'id3'},
+            'unchanged too': {'trigger unchanged': 'id4'},
+            'missing': 'no id found for trigger'})
+
+    def test_result_full(self):
+
+        '''Full result'''
+
+        self.assertIs(self.moira_ansible.result(),
+                      self.moira_ansible.success)
+
+    def test_result_summary(self):
+
+        '''Number of triggers per action'''
+
+        self.assertEqual(self.moira_ansible.result('summary'), {
+            'total': 5,
+            'actions': {
+                'new trigger created': 1,
+                'trigger changed': 1,
+                'trigger unchanged': 2,
+                'no id found for trigger': 1}})
+
+    def test_result_file(self):
+
+        '''Full result saved as json lines'''
+
+        tmp_dir = tempfile.mkdtemp()
+        path = os.path.join(tmp_dir, 'result.jsonl')
+
+        try:
+            result = self.moira_ansible.result('file', path)
+            with open(path) as result_file:
+                lines = [json.loads(line) for line in result_file]
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        self.assertEqual(result, {'total': 5, 'path': path})
+        self.assertEqual(
+            dict((line['name'], line['result']) for line in lines),
+            self.moira_ansible.success)
+
+    def test_result_file_failed(self):
+
+        '''Unable to save result'''
+
+        tmp_dir = tempfile.mkdtemp()
+
+        try:
+            self.assertIsNone(self.moira_ansible.result(
+                'file', os.path.join(tmp_dir, 'missing', 'result.jsonl')))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        self.assertIn('Unable To Save Result', self.moira_ansible.failed)
+
+
+class TestTriggerValidator(unittest.TestCase):
+
+    '''Test validation of trigger params'''
+
+    def setUp(self):
+
+        self.validator = TriggerValidator()
+        self.trigger = {
+            'name': 'valid',
+            'targets': ['sumSeries(dc1.{api,web}.rps)', 'dc1.db.rps'],
+            'expression': 'ERROR if t1 > t2 else WARN if t1 > 1 else OK',
+            'ttl': '600',
+            'ttl_state': 'NODATA',
+            'disabled_days': {'Mon': None}}
+
+    def test_valid_trigger(self):
+
+        '''Valid trigger has no errors'''
+
+        self.assertEqual(self.validator.validate(self.trigger), [])
+        self.assertEqual(self.validator.validate(
+            {'name': 'simple', 'targets': ['a.b'],
+             'warn_value': 300, 'error_value': 600}), [])
+
+    def test_invalid_triggers(self):
+
+        '''All errors are reported together'''
+
+        invalid = self.validator.validate_all([
+            self.trigger,
+            dict(self.trigger, name='targets',
+                 targets=['sumSeries(a.b', 'c.d)', "alias(e, 'f)"]),
+            dict(self.trigger, name='expression',
+                 expression='ERROR if t3 > 1 else OK'),
+            dict(self.trigger, name='syntax', expression='ERROR if'),
+            dict(self.trigger, name='thresholds', expression='',
+                 warn_value=1, error_value=1),
+            dict(self.trigger, name='schedule', ttl='-1',
+                 disabled_days={'Holiday': None})])
+
+        self.assertEqual(sorted(invalid), [
+            'expression', 'schedule', 'syntax', 'targets', 'thresholds'])
+        self.assertEqual(len(invalid['targets']), 3)
+        self.assertEqual(invalid['expression'],
+                         ['unknown names in expression: t3'])
+        self.assertIn('invalid expression', invalid['syntax'][0])
+        self.assertEqual(invalid['thresholds'],
+                         ['warn_value and error_value must differ'])
+        self.assertEqual(len(invalid['schedule']), 2)
+
+    def test_expression_syntaxes(self):
+
+        '''Python and govaluate expressions are both checked'''
+
+        valid = [
+            'ERROR if t1 > 10 else OK',
+            '(t1 > 10 and t2 < 3) and ERROR or OK',
+            't1 > 10 ? ERROR : OK',
+            '(t1 > 10 && t2 < 3) ? ERROR : OK',
+            't1 > t2 ? ERROR : (t1 > 1 || PREV_STATE == "WARN") ? WARN : OK',
+            'true ? OK : NODATA']
+        invalid = {
+            'ERROR if t1 > 10': 'invalid expression',
+            'ERROR if t3 > 10 else OK': 'unknown names in expression: t3',
+            't1 > 10 ? ERROR': 'invalid expression',
+            '(t1 > 10 && t2 < 3 ? ERROR : OK': 'invalid expression',
+            't1 > 10 ? ERROR : OK ||': 'invalid expression',
+            't1 # 10 ? ERROR : OK': 'invalid expression',
+            't3 > 10 ? ERROR : OK': 'unknown names in expression: t3'}
+
+        for expression in valid:
+            self.assertEqual(
+                self.validator.expression_errors(expression, 2), [],
+                expression)
+        for expression, error in invalid.items():
+            errors = self.validator.expression_errors(expression, 2)
+            self.assertEqual(len(errors), 1, expression)
+            self.assertTrue(errors[0].startswith(error), errors)
+
+    def test_memoized(self):
+
+        '''Same definitions are validated once'''
+
+        triggers = expand_triggers(
+            dict(self.trigger, name='$number'),
+            {'number': list(range(10000))})
+
+        self.assertEqual(self.validator.validate_all(triggers), {})
+        self.assertEqual(len(self.validator._definitions), 1)
+        self.assertEqual(len(self.validator._expressions), 1)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    '''Test circuit breaker shared by module runs'''
+
+    api_url = 'http://moira/api/'
+
+    def setUp(self):
+
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+
+        shutil.rmtree(self.tmp_dir)
+
+    def _breaker(self, api_url=api_url):
+
+        '''New breaker as in the next module run'''
+
+        return CircuitBreaker(
+            cache_dir=self.tmp_dir,
+            api_url=api_url,
+            threshold=2,
+            timeout=60)
+
+    def _expire(self):
+
+        '''Pretend that breaker timeout has passed'''
+
+        breaker = self._breaker()
+        state = breaker._load()
+        state['opened_at'] -= breaker.timeout
+        breaker._save(state)
+
+    def test_breaker_opens(self):
+
+        '''Breaker opens after threshold failures'''
+
+        self._breaker().failure()
+        self.assertIsNone(self._breaker().blocked())
+
+        self._breaker().failure()
+        self.assertIn('2 consecutive failures', self._breaker().blocked())
+        self.assertIsNone(self._breaker('http://other/api/').blocked())
+
+    def test_breaker_recovers(self):
+
+        '''Single probe closes breaker after timeout'''
+
+        for _ in range(2):
+            self._breaker().failure()
+        self._expire()
+
+        self.assertIsNone(self._breaker().blocked())
+        self.assertIsNotNone(self._breaker().blocked())
+
+        self._breaker().success()
+        self.assertIsNone(self._breaker().blocked())
+        self.assertEqual(self._breaker()._load()['failures'], 0)
+
+    def test_breaker_probe_fails(self):
+
+        '''Failed probe opens breaker again'''
+
+        for _ in range(2):
+            self._breaker().failure()
+        self._expire()
+
+        self.assertIsNone(self._breaker().blocked())
+        self._breaker().failure()
+        self.assertIn('3 consecutive failures', self._breaker().blocked())
+
+    def _parallel(self, method, runs=16):
+
+        '''Call breaker method from concurrent module runs'''
+
+        results = []
+        threads = [
+            threading.Thread(
+                target=lambda: results.append(
+                    getattr(self._breaker(), method)()))
+            for _ in range(runs)]
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return results
+
+    def test_parallel_failures(self):
+
+        '''Concurrent failures are all counted'''
+
+        self._parallel('failure')
+        self.assertEqual(self._breaker()._load()['failures'], 16)
+
+    def test_parallel_probe(self):
+
+        '''Single concurrent run probes API after timeout'''
+
+        for _ in range(2):
+            self._breaker().failure()
+        self._expire()
+
+        results = self._parallel('blocked')
+        self.assertEqual(
+            len([result for result in results if result is None]), 1)
+
+
+@unittest.skipUnless(HAS_MOIRA_CLIENT, 'module not found: moira_client')
+class TestCoordinator(unittest.TestCase):
+
+    '''Test work sharing between concurrent module runs'''
+
+    def setUp(self):
+
+        self.tmp_dir = tempfile.mkdtemp()
+        self.moira = FakeMoira()
+        self.trigger = {
+            'name': 'shared',
+            'targets': ['shared.rps'],
+            'desc': '',
+            'tags': ['shared'],
+            'expression': '',
+            'disabled_days': {}}
+        self.moira.seed([{'name': 'other', 'targets': ['other.rps']}])
+
+    def tearDown(self):
+
+        shutil.rmtree(self.tmp_dir)
+
+    def _moira_ansible(self):
+
+        '''New module run'''
+
+        return MoiraAnsible(
+            self.moira,
+            coordinator=Coordinator(
+                cache_dir=self.tmp_dir,
+                api_url='http://moira/api/',
+                window=60))
+
+    def test_shared_trigger_list(self):
+
+        '''Trigger list fetched once and updated by module runs'''
+
+        first = self._moira_ansible()
+        first.trigger_customize(self.trigger, 'present')
+        second = self._moira_ansible()
+        second.trigger_customize(self.trigger, 'present')
+
+        self.assertIn('new trigger created', first.success['shared'])
+        self.assertIn('trigger changed', second.success['shared'])
+        # moira-client Trigger.save fetches trigger list by itself
+        self.assertEqual(self.moira.calls.counts['GET trigger'], 2)
+
+        second.trigger_customize(self.trigger, 'absent')
+        self._moira_ansible().trigger_customize(self.trigger, 'absent')
+
+        self.assertEqual(self.moira.calls.counts['GET trigger'], 2)
+        self.assertEqual(self.moira.calls.counts['DELETE trigger/{id}'], 1)
+        self.assertEqual(len(self.moira.triggers), 1)
+
+    def test_stale_trigger_id(self):
+
+        '''Trigger removed outside of module is created again'''
+
+        self._moira_ansible().trigger_customize(self.trigger, 'present')
+        self.moira.triggers.clear()
+
+        recreated = self._moira_ansible()
+        recreated.trigger_customize(self.trigger, 'present')
+
+        self.assertFalse(recreated.failed)
+        self.assertIn('new trigger created', recreated.success['shared'])
+        self.assertEqual(len(self.moira.triggers), 1)
+
+    def test_parallel_create(self):
+
+        '''Concurrent runs create a single trigger'''
+
+        self.moira.latency = 0.01
+        runs = [self._moira_ansible() for _ in range(8)]
+        threads = [
+            threading.Thread(
+                target=run.trigger_customize,
+                args=(self.trigger, 'present'))
+            for run in runs]
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertFalse([run.failed for run in runs if run.failed])
+        self.assertEqual(
+            sorted(trigger['name']
+                   for trigger in self.moira.triggers.values()),
+            ['other', 'shared'])
+        self.assertEqual(self.moira.calls.counts['GET trigger'], 2)
+
+    def test_lock_buckets(self):
+
+        '''Lock files do not grow with number of triggers'''
+
+        triggers = expand_triggers(
+            dict(self.trigger, name='shared $number'),
+            {'number': list(range(500))})
+
+        self._moira_ansible().triggers_customize(triggers, 'present')
+
+        lock_files = [path for path in os.listdir(self.tmp_dir)
+                      if '-trigger-' in path]
+        self.assertEqual(len(self.moira.triggers), 501)
+        self.assertLessEqual(len(lock_files), LOCK_BUCKETS)
+
+    def test_cache_dir_lost(self):
+
+        '''Runs continue without coordination if cache dir is lost'''
+
+        run = self._moira_ansible()
+        shutil.rmtree(self.tmp_dir)
+
+        run.trigger_customize(self.trigger, 'present')
+
+        self.assertFalse(run.failed)
+        self.assertIsNone(run.coordinator)
+        self.assertEqual(len(run.warnings), 1)
+        self.assertIn('without coordination', run.warnings[0])
+        self.assertIn('new trigger created', run.success['shared'])
+        self.assertTrue(run.task_due('tag_cleanup'))
+        os.mkdir(self.tmp_dir)
+
+    def test_cache_write_failed(self):
+
+        '''Failed cache update is reported as warning'''
+
+        created = self._moira_ansible()
+        created.trigger_customize(self.trigger, 'present')
+        self.assertTrue(created.coordinator.once('tag_cleanup'))
+
+        for path in os.listdir(self.tmp_dir):
+            if not path.endswith('.lock'):
+                path = os.path.join(self.tmp_dir, path)
+                os.remove(path)
+                os.mkdir(path)
+                os.utime(path, (0, 0))
+
+        cleanup = self._moira_ansible()
+        self.assertTrue(cleanup.task_due('tag_cleanup'))
+        lookup = self._moira_ansible()
+        self.assertEqual(
+            lookup.get_trigger_id('shared'),
+            created.success['shared']['new trigger created'])
+
+        for run in cleanup, lookup:
+            self.assertFalse(run.failed)
+            self.assertIsNone(run.coordinator)
+            self.assertEqual(len(run.warnings), 1)
+
+    def test_private_cache_dir(self):
+
+        '''Cache dir is created private, shared dirs are refused'''
+
+        cache_dir = os.path.join(self.tmp_dir, 'cache')
+        Coordinator(cache_dir=cache_dir, api_url='', window=60)
+        self.assertEqual(os.stat(cache_dir).st_mode & 0o777, 0o700)
+
+        os.chmod(cache_dir, 0o1777)
+        with self.assertRaises(OSError):
+            Coordinator(cache_dir=cache_dir, api_url='', window=60)
+        with self.assertRaises(OSError):
+            CircuitBreaker(
+                cache_dir=cache_dir, api_url='', threshold=2, timeout=60)
+
+    def test_once_per_window(self):
+
+        '''Periodic task runs once per cache window'''
+
+        self.assertTrue(self._moira_ansible().coordinator.once('tag_cleanup'))
+        self.assertFalse(self._moira_ansible().coordinator.once('tag_cleanup'))
+
+
+@unittest.skipUnless(HAS_MOIRA_CLIENT, 'module not found: moira_client')
+class TestNameIds(unittest.TestCase):
+
+    '''Test trigger ids derived from names'''
+
+    namespace = uuid.UUID('4b1ffd8c-8f0e-5d3b-9a3e-6d6f69726121')
+
+    def setUp(self):
+
+        self.moira = FakeMoira()
+        self.trigger = {
+            'name': 'named',
+            'targets': ['named.rps'],
+            'desc': '',
+            'tags': [],
+            'expression': '',
+            'disabled_days': {}}
+        self.name_id = str(uuid.uuid5(self.namespace, 'named'))
+
+    def _moira_ansible(self, migrate_ids=False):
+
+        '''New module run'''
+
+        self.moira.calls.reset()
+        return MoiraAnsible(
+            self.moira,
+            id_namespace=self.namespace,
+            migrate_ids=migrate_ids)
+
+    def test_name_id_create(self):
+
+        '''Trigger created with id derived from name'''
+
+        created = self._moira_ansible()
+        created.trigger_customize(self.trigger, 'present')
+
+        self.assertFalse(created.failed)
+        self.assertEqual(
+            created.success['named'], {'new trigger created': self.name_id})
+        self.assertEqual(list(self.moira.triggers), [self.name_id])
+        self.assertEqual(self.moira.calls.counts, {
+            'GET trigger/{id}/state': 1,
+            'GET trigger': 1,
+            'PUT trigger': 1})
+
+        batch = self._moira_ansible()
+        batch.triggers_customize(
+            [self.trigger, dict(self.trigger, name='batch')], 'present')
+
+        self.assertFalse(batch.failed)
+        self.assertEqual(batch.success, {
+            'named': {'trigger unchanged': self.name_id},
+            'batch': {'new trigger created':
+                      str(uuid.uuid5(self.namespace, 'batch'))}})
+
+    def test_name_id_lookup(self):
+
+        '''Existing trigger fetched by id without trigger list'''
+
+        self.moira.seed([dict(self.trigger, id=self.name_id)])
+
+        unchanged = self._moira_ansible()
+        unchanged.trigger_customize(self.trigger, 'present')
+
+        self.assertFalse(unchanged.failed)
+        self.assertFalse(unchanged.changed)
+        self.assertEqual(
+            unchanged.success['named'], {'trigger unchanged': self.name_id})
+        self.assertEqual(self.moira.calls.counts, {
+            'GET trigger/{id}/state': 1,
+            'GET trigger/{id}': 1})
+
+        updated = self._moira_ansible()
+        updated.trigger_customize(
+            dict(self.trigger, desc='changed'), 'present')
+
+        self.assertFalse(updated.failed)
+        self.assertTrue(updated.changed)
+        self.assertEqual(
+            updated.success['named'], {'trigger changed': self.name_id})
+        self.assertEqual(self.moira.triggers[self.name_id]['desc'], 'changed')
+        self.assertEqual(self.moira.calls.counts, {
+            'GET trigger/{id}/state': 1,
+            'GET trigger/{id}': 1,
+            'PUT trigger/{id}': 1})
+
+        removed = self._moira_ansible()
+        removed.trigger_customize(self.trigger, 'absent')
+
+        self.assertEqual(
+            removed.success['named'], {'trigger removed': self.name_id})
+        self.assertEqual(self.moira.calls.counts, {
+            'GET trigger/{id}/state': 1,
+            'GET trigger/{id}': 1,
+            'DELETE trigger/{id}': 1})
+
+    def test_legacy_trigger(self):
+
+        '''Trigger with generated id found by name'''
+
+        legacy_id = self.moira.seed([self.trigger])[0]
+
+        updated = self._moira_ansible()
+        updated.trigger_customize(self.trigger, 'present')
+
+        self.assertFalse(updated.failed)
+        self.assertEqual(
+            updated.success['named'], {'trigger changed': legacy_id})
+        self.assertEqual(list(self.moira.triggers), [legacy_id])
+
+    def test_migrate_ids(self):
+
+        '''Trigger with generated id re-created'''
+
+        legacy_id = self.moira.seed([self.trigger])[0]
+
+        migrated = self._moira_ansible(migrate_ids=True)
+        migrated.trigger_customize(self.trigger, 'present')
+
+        self.assertFalse(migrated.failed)
+        self.assertEqual(migrated.success['named'], {
+            'trigger re-keyed': {'from': legacy_id, 'to': self.name_id}})
+        self.assertEqual(list(self.moira.triggers), [self.name_id])
+        self.assertEqual(
+            self.moira.triggers[self.name_id]['targets'], ['named.rps'])
+
+        batch = self._moira_ansible(migrate_ids=True)
+        batch.triggers_customize([self.trigger], 'present')
+
+        self.assertEqual(
+            batch.success['named'], {'trigger unchanged': self.name_id})
+
+
+@unittest.skipUnless(HAS_MOIRA_CLIENT, 'module not found: moira_client')
+class TestApiBudget(unittest.TestCase):
+
+    '''Test number of api requests against large Moira'''
+
+    triggers_count = 1000
+
+    def setUp(self):
+
+        self.moira = FakeMoira()
+        self.triggers = [{
+            'name': 'trigger' + str(number),
+            'targets': ['service' + str(number) + '.rps'],
+            'desc': '',
+            'tags': ['tag' + str(number % 10)],
+            'expression': '',
+            'disabled_days': {}}
+            for number in range(self.triggers_count)]
+        self.ids = self.moira.seed(self.triggers, tags=['unused'])
+        self.moira_ansible = MoiraAnsible(self.moira)
+
+    def assertBudget(self, requests, counts=None):
+
+        '''Check number of requests in total and per endpoint'''
+
+        self.assertFalse(self.moira_ansible.failed)
+        self.assertLessEqual(self.moira.calls.requests(), requests)
+        if counts is not None:
+            self.assertEqual(self.moira.calls.counts, counts)
+
+    def test_api_check_budget(self):
+
+        '''API check does not depend on number of triggers'''
+
+        self.assertTrue(self.moira_ansible.api_check())
+        self.assertBudget(3, {
+            'GET pattern': 1,
+            'GET tag': 1,
+            'GET trigger': 1})
+
+    def test_unchanged_trigger_budget(self):
+
+        '''Reconcile unchanged trigger'''
+
+        self.moira_ansible.trigger_customize(self.triggers[-1], 'present')
+
+        self.assertBudget(6, {
+            'GET trigger': 1,
+            'GET trigger/{id}/state': 2,
+            'GET trigger/{id}': 2,
+            'PUT trigger/{id}': 1})
+        self.assertEqual(len(self.moira.triggers), self.triggers_count)
+
+    def test_new_trigger_budget(self):
+
+        '''Create new trigger'''
+
+        self.moira_ansible.trigger_customize(
+            dict(self.triggers[0], name='new'), 'present')
+
+        self.assertBudget(6, {
+            'GET trigger': 2,
+            'PUT trigger': 1,
+            'GET trigger/{id}/state': 1,
+            'GET trigger/{id}': 1,
+            'PUT trigger/{id}': 1})
+        self.assertEqual(len(self.moira.triggers), self.triggers_count + 1)
+
+    def test_trigger_remove_budget(self):
+
+        '''Remove existing trigger'''
+
+        self.moira_ansible.trigger_customize(self.triggers[0], 'absent')
+
+        self.assertBudget(2, {
+            'GET trigger': 1,
+            'DELETE trigger/{id}': 1})
+        self.assertNotIn(self.ids[0], self.moira.triggers)
+
+    def test_tag_cleanup_budget(self):
+
+        '''Only unused tags are removed'''
+
+        self.moira_ansible.tag_cleanup()
+
+        self.assertBudget(2, {
+            'GET tag/stats': 1,
+            'DELETE tag/{name}': 1})
+        self.assertNotIn('unused', self.moira.tags)
+
+    def test_unchanged_triggers_batch_budget(self):
+
+        '''Reconcile all unchanged triggers with a single request'''
+
+        self.moira_ansible.triggers_customize(
+            [dict(trigger, ttl='600') for trigger in self.triggers],
+            'present')
+
+        self.assertBudget(1, {'GET trigger': 1})
+        self.assertFalse(self.moira_ansible.changed)
+        self.assertEqual(
+            self.moira_ansible.success['trigger0'],
+            {'trigger unchanged': self.ids[0]})
+
+    def test_triggers_batch_budget(self):
+
+        '''Requests are made only for changed triggers'''
+
+        triggers = [dict(trigger) for trigger in self.triggers]
+        triggers[0]['desc'] = 'changed'
+        triggers.append(dict(triggers[1], name='new'))
+
+        self.moira_ansible.triggers_customize(triggers, 'present')
+
+        self.assertBudget(3, {
+            'GET trigger': 1,
+            'PUT trigger/{id}': 1,
+            'PUT trigger': 1})
+        self.assertTrue(self.moira_ansible.changed)
+        self.assertIn(
+            'trigger changed', self.moira_ansible.success['trigger0'])
+        self.assertIn('new trigger created', self.moira_ansible.success['new'])
+
+    def test_triggers_batch_failures(self):
+
+        '''Failures of every trigger in a batch are reported'''
+
+        triggers = [dict(trigger) for trigger in self.triggers[:3]]
+        for trigger in triggers:
+            trigger['desc'] = 'changed'
+        triggers.append(dict(triggers[0], name='new'))
+        self.moira.failing.update(['trigger0', 'trigger2', 'new'])
+
+        self.moira_ansible.triggers_customize(triggers, 'present')
+
+        failed = self.moira_ansible.failed['API Request Failed']
+        self.assertEqual(sorted(failed), ['new', 'trigger0', 'trigger2'])
+        self.assertIn('500', failed['trigger2'][
+            'Trigger Write (trigger.put)']['details'])
+        self.assertIn('Trigger Add (trigger.put)', failed['new'])
+        self.assertEqual(list(self.moira_ansible.success), ['trigger1'])
+
+    def test_new_triggers_batch_budget(self):
+
+        '''New triggers saved without fetching trigger list again'''
+
+        triggers = expand_triggers(
+            dict(self.triggers[0], name='new $number',
+                 targets=['new.$number.rps'], ttl='600'),
+            {'number': list(range(2000))})
+
+        self.moira_ansible.triggers_customize(triggers, 'present')
+
+        self.assertBudget(2001, {
+            'GET trigger': 1,
+            'PUT trigger': 2000})
+        self.assertEqual(len(self.moira.triggers), self.triggers_count + 2000)
+
+        self.moira.calls.reset()
+        self.moira_ansible = MoiraAnsible(self.moira)
+        self.moira_ansible.triggers_customize(triggers, 'present')
+
+        self.assertBudget(1, {'GET trigger': 1})
+        self.assertEqual(
+            self.moira_ansible.result('summary')['actions'],
+            {'trigger unchanged': 2000})
+
+    def test_triggers_batch_remove_budget(self):
+
+        '''Remove triggers with a single trigger list request'''
+
+        self.moira_ansible.triggers_customize(
+            self.triggers[:10] + [dict(self.triggers[0], name='missing')],
+            'absent')
+
+        self.assertBudget(11, {
+            'GET trigger': 1,
+            'DELETE trigger/{id}': 10})
+        self.assertEqual(
+            self.moira_ansible.success['missing'], 'no id found for trigger')
+        self.assertEqual(len(self.moira.triggers), self.triggers_count - 10)
+
+    def test_snapshot_export_budget(self):
+
+        '''Snapshot export fetches triggers and tags once'''
+
+        tmp_dir = tempfile.mkdtemp()
+
+        try:
+            self.moira_ansible.snapshot_export(
+                os.path.join(tmp_dir, 'moira.snapshot.gz'))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        self.assertBudget(2, {
+            'GET trigger': 1,
+            'GET tag/stats': 1})
+
+
+class TestModuleGates(unittest.TestCase):
+
+    '''Test module runs stopped or served before Moira api'''
+
+    def setUp(self):
+
+        self.tmp_dir = tempfile.mkdtemp()
+        self.params = {
+            'name': 'rps $number',
+            'targets': ['service$number.rps'],
+            'matrix': {'number': [1, 2]}}
+
+    def tearDown(self):
+
+        shutil.rmtree(self.tmp_dir)
+
+    def test_invalid_triggers(self):
+
+        '''Invalid triggers fail module run'''
+
+        failed, result = moira_run(StubModule(
+            **dict(self.params, targets=['sumSeries(service$number.rps'])))
+
+        self.assertTrue(failed)
+        self.assertEqual(
+            sorted(result['msg']['Trigger Validation Failed']),
+            ['rps 1', 'rps 2'])
+
+    def test_matrix_duplicates(self):
+
+        '''Matrix producing same names fails module run'''
+
+        failed, result = moira_run(StubModule(
+            **dict(self.params, matrix={'number': [1, 2, 1]})))
+
+        self.assertTrue(failed)
+        self.assertEqual(result['msg'], {
+            'Matrix produces triggers with same names': ['rps 1']})
+
+    def test_offline_check_mode(self):
+
+        '''Check mode with snapshot compares triggers offline'''
+
+        path = os.path.join(self.tmp_dir, 'moira.snapshot.gz')
+        snapshot = MoiraSnapshot()
+        snapshot.trigger.create(
+            id='1', name='rps 1', targets=['service1.rps'], desc='',
+            tags=[], expression='', disabled_days=set()).save()
+        MoiraSnapshot.dump(snapshot, path)
+
+        failed, result = moira_run(StubModule(
+            check_mode=True, snapshot=path, **self.params))
+
+        self.assertFalse(failed)
+        self.assertTrue(result['changed'])
+        self.assertEqual(result['result'], {
+            'rps 1': {'trigger unchanged': '1'},
+            'rps 2': {'new trigger created': 'gh0st'}})
+
+
+@unittest.skipUnless(HAS_MOIRA_CLIENT, 'module not found: moira_client')
+class TestModuleRun(unittest.TestCase):
+
+    '''Test module runs with stub ansible module'''
+
+    def setUp(self):
+
+        self.tmp_dir = tempfile.mkdtemp()
+        self.moira = FakeMoira()
+        self.moira.seed([{'name': 'seeded', 'targets': ['seeded.rps']}])
+        self.moira_client = moira_trigger.Moira
+        moira_trigger.Moira = lambda **api: self.moira
+        self.params = {
+            'name': 'rps $number',
+            'targets': ['service$number.rps'],
+            'matrix': {'number': [1, 2, 3]},
+            'cache_dir': os.path.join(self.tmp_dir, 'cache')}
+
+    def tearDown(self):
+
+        moira_trigger.Moira = self.moira_client
+        shutil.rmtree(self.tmp_dir)
+
+    def test_partial_failure_summary(self):
+
+        '''Summary of processed triggers returned with failures'''
+
+        self.moira.failing.add('rps 2')
+
+        failed, result = moira_run(
+            StubModule(result_format='summary', **self.params))
+
+        self.assertTrue(failed)
+        self.assertEqual(
+            list(result['msg']['API Request Failed']), ['rps 2'])
+        self.assertEqual(result['result'], {
+            'total': 2, 'actions': {'new trigger created': 2}})
+        self.assertTrue(result['changed'])
+
+    def test_partial_failure_file(self):
+
+        '''Result file written for processed triggers with failures'''
+
+        self.moira.failing.add('rps 2')
+        result_file = os.path.join(self.tmp_dir, 'result.jsonl')
+
+        failed, result = moira_run(StubModule(
+            result_format='file', result_file=result_file, **self.params))
+
+        self.assertTrue(failed)
+        self.assertEqual(
+            result['result'], {'total': 2, 'path': result_file})
+        with open(result_file) as result_lines:
+            self.assertEqual(
+                sorted(json.loads(line)['name'] for line in result_lines),
+                ['rps 1', 'rps 3'])
+
+    def test_breaker_cache_dir_lost(self):
+
+        '''Breaker failing after api check fails module run'''
+
+        breaker = CircuitBreaker(
+            cache_dir=self.params['cache_dir'],
+            api_url='http://moira/api/',
+            threshold=2,
+            timeout=60)
+        api_get = self.moira.get
+
+        def lose_cache_dir(parts):
+            if not os.path.isdir(breaker.lock_path):
+                os.remove(breaker.lock_path)
+                os.mkdir(breaker.lock_path)
+            return api_get(parts)
+
+        self.moira.get = lose_cache_dir
+
+        failed, result = moira_run(
+            StubModule(breaker_threshold=2, **self.params))
+
+        self.assertTrue(failed)
+        self.assertIn('Unable to use cache directory', result['msg'])
+
+    def test_breaker_opens(self):
+
+        '''Module runs fail fast after api check failures'''
+
+        def unavailable(parts):
+            raise ValueError('/'.join(parts))
+
+        self.moira.get = unavailable
+        params = dict(self.params, breaker_threshold=1)
+
+        failed, result = moira_run(StubModule(**params))
+
+        self.assertTrue(failed)
+        self.assertIn('API Unavailable', result['msg'])
+
+        self.moira.calls.reset()
+        failed, result = moira_run(StubModule(**params))
+
+        self.assertTrue(failed)
+        self.assertIn('Circuit breaker is open', result['msg'])
+        self.assertEqual(self.moira.calls.requests(), 0)
+
+
 if __name__ == '__main__':
     unittest.main()
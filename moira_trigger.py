@@ -64,12 +64,108 @@ options:
       - Desired state of a trigger.
       - Use state 'present' to create and edit existing triggers.
       - Use state 'absent' to delete triggers.
+      - Use state 'exported' to save all triggers and tags to 'snapshot'.
     required: True
-    choices: ['present', 'absent']
+    choices: ['present', 'absent', 'exported']
+  snapshot:
+    description:
+      - Path to a local snapshot of Moira triggers and tags.
+      - Written when state is 'exported'.
+      - In check mode, triggers are compared against the snapshot
+        instead of Moira API, no network access is required.
+    required: False
+    default: None
+  profile:
+    description:
+      - Path to save cProfile data of the module run.
+      - Hot functions summary is returned as 'profile'.
+      - Can also be set with MOIRA_TRIGGER_PROFILE environment variable.
+    required: False
+    default: None
+  cache_dir:
+    description:
+      - Directory for controller-local state shared by module runs.
+      - Defaults to ~/.ansible/tmp/moira_trigger.
+      - Created with 0700 mode, module fails if the directory is owned
+        by another user or writable by group or others.
+    required: False
+    default: None
+  breaker_threshold:
+    description:
+      - Number of consecutive API check failures to open circuit breaker.
+      - While breaker is open, tasks for the same api_url fail immediately.
+      - Use 0 to disable circuit breaker.
+    required: False
+    default: 0
+  breaker_timeout:
+    description:
+      - Seconds before the next task probes API after breaker is opened.
+    required: False
+    default: 60
+  cache_window:
+    description:
+      - Seconds to share work between concurrent tasks on the controller.
+      - Trigger list is fetched once per window and shared via cache_dir,
+        triggers with the same name are created one at a time
+        and unused tags are removed once per window.
+      - Use 0 to disable.
+    required: False
+    default: 0
+  matrix:
+    description:
+      - Lists of values by axis name to generate triggers from one definition.
+      - A trigger is made for every combination of axes values,
+        $axis placeholders in name, desc, targets and tags are replaced
+        with the axis value.
+      - Generated triggers are processed with a single trigger list request.
+    required: False
+    default: None
+  result_format:
+    description:
+      - Use 'full' to return state and id of every trigger.
+      - Use 'summary' to return number of triggers per action.
+      - Use 'file' to save full result to 'result_file' as json lines
+        and return its path.
+      - Errors are always reported in full.
+    required: False
+    default: 'full'
+    choices: ['full', 'summary', 'file']
+  result_file:
+    description:
+      - Path to save full result, required if result_format is 'file'.
+    required: False
+    default: None
+  validate:
+    description:
+      - Check targets, expression, thresholds, ttl and disabled_days
+        of all triggers before any API request.
+      - Errors of all invalid triggers are reported together.
+    required: False
+    default: True
+  name_ids:
+    description:
+      - Create triggers with ids derived from their names (uuid5).
+      - Triggers are fetched, updated and deleted by id without
+        fetching the whole trigger list. Triggers created without
+        this option are still found by name.
+    required: False
+    default: False
+  id_namespace:
+    description:
+      - Namespace uuid for trigger ids derived from names.
+    required: False
+    default: '4b1ffd8c-8f0e-5d3b-9a3e-6d6f69726121'
+  migrate_ids:
+    description:
+      - Re-create triggers found by name with ids derived from their names.
+      - Used only with name_ids.
+    required: False
+    default: False
   name:
     description:
       - Trigger name.
-    required: True
+      - Required if state is 'present' or 'absent'.
+    required: False
   desc:
     description:
       - Trigger description.
@@ -88,7 +184,8 @@ options:
     choices: ['NODATA', 'ERROR', 'WARN', 'OK']
   expression:
     description:
-      - Python expression.
+      - Python expression or govaluate expression, e.g.
+        't1 > 10 ? ERROR : OK'.
     required: False
     default: ''
   disabled_days:
@@ -99,7 +196,8 @@ options:
   targets:
     description:
       - List of trigger targets.
-    required: True
+      - Required if state is 'present' or 'absent'.
+    required: False
   tags:
     description:
       - List of trigger tags.
@@ -146,12 +244,59 @@ EXAMPLES = '''
       targets:
         - test3.rps
         - test4.rps
+
+# Trigger family example.
+- name: MoiraAnsible
+  moira_trigger:
+     api_url: http://localhost/api/
+     state: present
+     name: '$service rps in $dc'
+     warn_value: 300
+     error_value: 600
+     tags:
+       - '$service'
+     targets:
+       - '$dc.$service.rps'
+     matrix:
+       service:
+         - api
+         - web
+       dc:
+         - dc1
+         - dc2
+
+# Snapshot export example.
+- name: MoiraAnsible
+  moira_trigger:
+     api_url: http://localhost/api/
+     state: exported
+     snapshot: /tmp/moira.snapshot.gz
 '''
 
 RETURN = '''
-success:
-  description: Dictionary with current trigger state and id
-  returned: success
+profile:
+  description: Profile file path, timings and hottest functions
+  returned: when profiling is enabled
+  type: dict
+  sample: {
+    'path': '/tmp/moira_trigger.prof',
+    'wall_time': 1.2,
+    'cpu_time': 0.3,
+    'functions': [{
+      'function': "{method 'recv_into' of '_socket.socket' objects}",
+      'calls': 12,
+      'tottime': 0.9,
+      'cumtime': 0.9
+    }]
+  }
+result:
+  description:
+    - State and id of every trigger if result_format is 'full'.
+    - Number of triggers per action if result_format is 'summary'.
+    - Number of triggers and result file path if result_format is 'file'.
+    - Returned for processed triggers also when some triggers failed,
+      failures are returned in 'msg'.
+  returned: when triggers were processed
   type: dict
   sample: {
     'test2': {
@@ -160,6 +305,24 @@ success:
   }
 '''
 
+import ast
+import cProfile
+import errno
+import fcntl
+import gzip
+import hashlib
+import itertools
+import json
+import os
+import pstats
+import re
+import stat
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from string import Template
+
 try:
     from moira_client import Moira
     HAS_MOIRA_CLIENT = True
@@ -168,307 +331,1912 @@ except ImportError:
 
 from ansible.module_utils.basic import AnsibleModule
 
+CACHE_DIR = os.path.join('~', '.ansible', 'tmp', 'moira_trigger')
+LOCK_BUCKETS = 64
 
-class MoiraAnsible(object):
-
-    '''Create, edit and delete Moira triggers.
+PROFILE_ENV = 'MOIRA_TRIGGER_PROFILE'
+PROFILE_TOP = 20
 
-    Attributes:
-        moira_api (class): moira api client.
-        changed (bool): actual trigger state.
-        dry_run (bool): enables check mode.
-        failed (dict): error message (if occurred).
-        success (dict): trigger state and id.
-        warnings (list): module warnings.
+DAYS = 'Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun'
+STATES = 'NODATA', 'ERROR', 'WARN', 'OK'
+EXPRESSION_NAMES = 'OK', 'WARN', 'WARNING', 'ERROR', 'NODATA', \
+                   'PREV_STATE', 'True', 'False', 'None'
+VALIDATED_FIELDS = 'targets', 'expression', 'warn_value', 'error_value', \
+                   'ttl', 'ttl_state', 'disabled_days'
+BRACKETS = {')': '(', ']': '[', '}': '{'}
+GOVALUATE_NAMES = 'true', 'false'
+GOVALUATE_TOKEN = re.compile(
+    r'\s*(?:(?P<string>\'[^\']*\'|"[^"]*")'
+    r'|(?P<number>\d+(?:\.\d+)?)'
+    r'|(?P<name>[A-Za-z_]\w*)'
+    r'|(?P<operator>&&|\|\||\?\?|[=!]~|[=!<>]=|\*\*|<<|>>'
+    r'|[-+*/%&|^<>!~?:(),]))')
 
-    '''
+ID_NAMESPACE = '4b1ffd8c-8f0e-5d3b-9a3e-6d6f69726121'
 
-    def __init__(self,
-                 moira_api,
-                 changed=False,
-                 dry_run=False,
-                 failed=None,
-                 success=None,
-                 warnings=None):
+TEMPLATE_FIELDS = 'name', 'desc', 'targets', 'tags'
 
-        self.moira_api = moira_api
-        self.changed = changed
-        self.dry_run = dry_run
-        failed = {}
-        self.failed = failed
-        success = {}
-        self.success = success
-        warnings = []
-        self.warnings = warnings
+DEFAULT_SCHED = {'startOffset': 0, 'endOffset': 1439, 'tzOffset': 0}
+TRIGGER_BODY_FIELDS = 'name', 'tags', 'targets', 'warn_value', 'error_value', \
+                      'desc', 'ttl', 'ttl_state', 'expression', 'is_remote', \
+                      'trigger_type', 'mute_new_metrics'
 
-    def exception_handler(self, occurred, component,
-                          desc='API Request Failed',
-                          level='error'):
+try:
+    STRING_TYPES = basestring
+except NameError:
+    STRING_TYPES = str
 
-        '''Handling occurred exceptions.
+SNAPSHOT_VERSION = 1
+SNAPSHOT_FIELDS = 'id', 'name', 'desc', 'ttl', 'ttl_state', 'expression', \
+                  'disabled_days', 'targets', 'tags', 'warn_value', \
+                  'error_value'
 
-        Args:
-            occurred (class): exception.
-            component (str): component name.
-            desc (str): description.
-            level (str): level of importance ('warn' or 'error').
 
-        '''
+def profile_call(path, function, *args):
 
-        if level == 'error':
+    '''Run function under cProfile.
 
-            exception_body = {
-                'error': occurred.__class__.__name__,
-                'details': str(occurred)}
+    Args:
+        path (str): file to save profile data.
+        function (function): function to profile.
+        args (tuple): function arguments.
 
-            if desc not in self.failed:
-                self.failed[desc] = {
-                    component: exception_body}
+    Returns:
+        Tuple of function result and hot functions summary.
 
-            else:
-                self.failed[desc].update({
-                    component: exception_body})
+    '''
 
-        elif level == 'warn':
+    profiler = cProfile.Profile()
+    started = time.time(), sum(os.times()[:2])
+    result = profiler.runcall(function, *args)
+    wall_time = time.time() - started[0]
+    cpu_time = sum(os.times()[:2]) - started[1]
 
-            exception_body = (
-                component + ' warning: ' + desc +
-                ' Reason: ' + occurred.__class__.__name__)
+    stats = pstats.Stats(profiler)
+    hot_functions = sorted(
+        stats.stats.items(),
+        key=lambda item: item[1][2],
+        reverse=True)[:PROFILE_TOP]
 
-            self.warnings.append(
-                exception_body)
+    summary = {
+        'path': path,
+        'wall_time': round(wall_time, 6),
+        'cpu_time': round(cpu_time, 6),
+        'functions': [{
+            'function': pstats.func_std_string(function_key),
+            'calls': calls,
+            'tottime': round(tottime, 6),
+            'cumtime': round(cumtime, 6)}
+            for function_key, (_, calls, tottime, cumtime, _)
+            in hot_functions]}
 
-    def api_check(self):
+    try:
+        profiler.dump_stats(path)
+    except Exception as dump_stats_exception:
+        summary['error'] = {
+            'error': dump_stats_exception.__class__.__name__,
+            'details': str(dump_stats_exception)}
 
-        '''Moira API availability check.
+    return result, summary
 
-        Returns:
-            True if no exceptions occurred, False otherwise.
 
-        '''
+def cache_key(api_url):
 
-        desc = 'API Unavailable'
-        components = 'pattern', 'tag', 'trigger'
+    '''Controller-local file name prefix for Moira API.
 
-        for component in components:
+    Args:
+        api_url (str): url of Moira API.
 
-            try:
-                self.moira_api.trigger.trigger_client.get(component)
-            except Exception as api_check_exception:
-                self.exception_handler(
-                    occurred=api_check_exception,
-                    component=component,
-                    desc=desc)
+    Returns:
+        Hash of api url.
 
-        return bool(desc not in self.failed)
+    '''
 
-    def tag_cleanup(self):
+    return hashlib.sha1(api_url.encode('utf-8')).hexdigest()
 
-        '''Remove unused tags.
 
-        '''
+def not_found(occurred):
 
-        unused = set()
+    '''Check if API request failed because object does not exist.
 
-        not_removed = 'Unable to remove unused tags. ' \
-                      'Tags can be removed on the next module execution.'
+    Args:
+        occurred (class): exception.
 
-        try:
-            for tag in self.moira_api.tag.stats():
-                if not tag.triggers:
-                    unused.add(self.moira_api.tag.delete(tag.name))
-            assert False not in unused
-        except Exception as tag_cleanup_exception:
-            self.exception_handler(
-                occurred=tag_cleanup_exception,
-                component='Tag Cleanup (tag.stats)',
-                desc=not_removed,
-                level='warn')
+    Returns:
+        True for HTTP 404 errors, False otherwise.
 
-    def get_trigger_id(self, trigger_name):
+    '''
 
-        '''Get trigger id by trigger name.
+    response = getattr(occurred, 'response', None)
+    return getattr(response, 'status_code', None) == 404
 
-        Args:
-            trigger_name (str): name of a trigger.
 
-        Returns:
-            Trigger id if found, None otherwise.
+def ensure_dir(path):
 
-        '''
+    '''Create private directory if it does not exist.
 
-        try:
-            all_triggers = self.moira_api.trigger.fetch_all()
-        except Exception as get_trigger_id_exception:
-            self.exception_handler(
-                occurred=get_trigger_id_exception,
-                component='Get Trigger ID (trigger.fetch_all)')
-            return
+    State and lock files are trusted by module runs, so the directory
+    must not be writable by other users.
 
-        for moira_trigger in all_triggers:
-            if moira_trigger.name == trigger_name:
-                return moira_trigger.id
+    Args:
+        path (str): directory path.
 
-    def trigger_update_check(self, moira_trigger, trigger):
+    Raises:
+        OSError: directory is owned by another user or writable
+            by group or others.
 
-        '''Check to make sure the trigger was updated.
+    '''
 
-        Args:
-            moira_trigger (class): existing Moira trigger.
-            trigger (dict): desired params for existing trigger.
+    try:
+        os.makedirs(path, 0o700)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
 
-        '''
+    status = os.stat(path)
 
-        not_updated = {}
+    if status.st_uid != os.getuid():
+        raise OSError(
+            errno.EPERM, 'Directory is owned by another user', path)
 
-        for parameter in trigger:
-            if not moira_trigger.__dict__[parameter] == trigger[parameter]:
-                not_updated.update({
-                    parameter: {
-                        'desired': trigger[parameter],
-                        'actual': moira_trigger.__dict__[parameter]}})
+    if status.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise OSError(
+            errno.EPERM, 'Directory is writable by other users', path)
 
-        if not_updated:
-            self.failed['failed_to_update_trigger'] = {
-                'trigger': trigger['name'],
-                'parameters': not_updated}
-        else:
-            self.changed = True
 
-    def trigger_update(self, moira_trigger, trigger):
+@contextmanager
+def file_lock(path):
 
-        '''Updates parameters of existing trigger.
+    '''Hold exclusive lock on file, shared by processes and threads.
 
-        Args:
-            moira_trigger (class): existing Moira trigger.
-            trigger (dict): desired params for existing trigger.
+    Args:
+        path (str): lock file path.
 
-        '''
+    '''
 
-        trigger_name = trigger['name']
+    with open(path, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
 
-        for parameter in trigger:
-            if not moira_trigger.__dict__[parameter] == trigger[parameter]:
-                moira_trigger.__dict__[parameter] = trigger[parameter]
 
-        if not self.dry_run:
+def text(value):
 
-            try:
-                moira_trigger.update()
-            except Exception as trigger_update_exception:
-                self.exception_handler(
-                    occurred=trigger_update_exception,
-                    component='Trigger Update (trigger.update)')
+    '''Convert value to string, keeping strings as is.
 
-            self.trigger_update_check(moira_trigger, trigger)
+    Args:
+        value (object): any value.
 
-        else:
+    Returns:
+        String.
 
-            self.changed = True
+    '''
 
-        if trigger_name not in self.success:
+    if isinstance(value, STRING_TYPES):
+        return value
+    return str(value)
 
-            self.success[trigger_name] = {
-                'trigger changed': moira_trigger.id}
 
-    def trigger_remove(self, trigger_name, trigger_id):
+def trigger_body(moira_trigger):
 
-        '''Remove trigger.
+    '''Moira API request body to save trigger.
 
-        Args:
-            trigger_name (str): trigger name.
-            trigger_id (str): trigger id.
+    Args:
+        moira_trigger (class): Moira trigger.
 
-        '''
+    Returns:
+        Trigger body as moira-client sends it.
 
-        if trigger_id is None:
+    '''
 
-            self.success.update({
-                trigger_name: 'no id found for trigger'})
+    body = dict(
+        (field, getattr(moira_trigger, field, None))
+        for field in TRIGGER_BODY_FIELDS)
+    body['is_remote'] = bool(body['is_remote'])
+    body['mute_new_metrics'] = bool(body['mute_new_metrics'])
 
-        else:
+    disabled_days = getattr(moira_trigger, 'disabled_days', None) or ()
+    body['sched'] = dict(
+        getattr(moira_trigger, 'sched', None) or DEFAULT_SCHED)
+    body['sched']['days'] = [
+        {'name': day, 'enabled': day not in disabled_days} for day in DAYS]
 
-            if not self.dry_run:
+    if moira_trigger.id is not None:
+        body['id'] = moira_trigger.id
 
-                try:
-                    self.moira_api.trigger.delete(trigger_id)
-                except Exception as trigger_remove_exception:
-                    self.exception_handler(
-                        occurred=trigger_remove_exception,
-                        component='Remove Trigger (trigger.delete)')
-                    return
+    return body
 
-            self.changed = True
-            self.success[trigger_name] = {
-                'trigger removed': trigger_id}
 
-    def trigger_edit(self, trigger, trigger_id):
+def expand_triggers(trigger, matrix):
 
-        '''Create new or edit existing trigger.
+    '''Generate triggers from template and axes of values.
 
-        Args:
-            trigger (dict): desired trigger params.
-            trigger_id (str): trigger id.
+    Every combination of axes values makes a trigger, $axis and ${axis}
+    placeholders in TEMPLATE_FIELDS are replaced with the axis value.
 
-        '''
+    Args:
+        trigger (dict): trigger template.
+        matrix (dict): list of values by axis name.
 
-        if trigger_id is not None:
+    Returns:
+        List of triggers.
 
-            try:
-                moira_trigger = self.moira_api.trigger.fetch_by_id(trigger_id)
-            except Exception as trigger_edit_exception:
-                self.exception_handler(
-                    occurred=trigger_edit_exception,
-                    component='Trigger Edit (trigger.fetch_by_id)')
-                return
+    '''
 
-        else:
+    axes = sorted(matrix)
+    values = [matrix[axis] if isinstance(matrix[axis], list)
+              else [matrix[axis]] for axis in axes]
+
+    templates = {}
+    for field in TEMPLATE_FIELDS:
+        if isinstance(trigger.get(field), list):
+            templates[field] = [
+                Template(text(item)) for item in trigger[field]]
+        elif trigger.get(field) is not None:
+            templates[field] = Template(text(trigger[field]))
+
+    triggers = []
+
+    for combination in itertools.product(*values):
+        mapping = dict(zip(axes, [text(value) for value in combination]))
+        expanded = dict(trigger)
+        for field, template in templates.items():
+            if isinstance(template, list):
+                expanded[field] = [item.safe_substitute(mapping)
+                                   for item in template]
+            else:
+                expanded[field] = template.safe_substitute(mapping)
+        triggers.append(expanded)
 
-            moira_trigger = self.moira_api.trigger.create(**trigger)
+    return triggers
 
-            if not self.dry_run:
 
-                try:
-                    moira_trigger.save()
-                except Exception as trigger_save_exception:
-                    self.exception_handler(
-                        occurred=trigger_save_exception,
-                        component='Trigger Edit (trigger.save)')
-                    return
+class TriggerValidator(object):
 
-                moira_trigger_id = moira_trigger.id
+    '''Check trigger params before any API request.
 
-            else:
+    Results are memoized by hash of validated params, so triggers with the
+    same definition are checked once. Targets and expressions are memoized
+    separately as they are shared by most of generated triggers.
 
-                moira_trigger_id = 'gh0st'
+    '''
 
-            self.changed = True
-            self.success[trigger['name']] = {
-                'new trigger created': moira_trigger_id}
+    def __init__(self):
 
-        self.trigger_update(moira_trigger, trigger)
+        self._definitions = {}
+        self._targets = {}
+        self._expressions = {}
 
-    def trigger_customize(self, trigger, state):
+    def target_errors(self, target):
 
-        '''General function to work with triggers.
+        '''Check target syntax.
 
         Args:
-            trigger (dict): desired trigger params.
-            state (str): desired trigger state.
+            target (str): graphite target.
+
+        Returns:
+            List of errors.
 
         '''
 
-        current_id = self.get_trigger_id(trigger['name'])
+        if target not in self._targets:
 
-        if state == 'absent':
-            self.trigger_remove(
-                trigger_name=trigger['name'],
-                trigger_id=current_id)
+            errors = []
+            opened = []
+            quote = None
+            target_text = text(target)
 
-        elif state == 'present':
-            self.trigger_edit(
-                trigger=trigger,
-                trigger_id=current_id)
+            if not target_text.strip():
+                errors.append('empty target')
+
+            for char in target_text:
+                if quote:
+                    if char == quote:
+                        quote = None
+                elif char in '\'"':
+                    quote = char
+                elif char in '([{':
+                    opened.append(char)
+                elif char in BRACKETS:
+                    if not opened or opened.pop() != BRACKETS[char]:
+                        errors.append('unbalanced ' + repr(char) +
+                                      ' in target ' + repr(target))
+                        break
+
+            if quote:
+                errors.append('unclosed quote in target ' + repr(target))
+            elif opened and not errors:
+                errors.append('unclosed ' + repr(opened[-1]) +
+                              ' in target ' + repr(target))
+
+            self._targets[target] = errors
+
+        return self._targets[target]
+
+    @staticmethod
+    def python_names(expression):
+
+        '''Parse expression in python syntax.
+
+        Args:
+            expression (str): trigger expression.
+
+        Returns:
+            Tuple of names used in expression and syntax error or None.
+
+        '''
+
+        try:
+            tree = ast.parse(expression.strip(), mode='eval')
+        except SyntaxError as expression_exception:
+            return [], str(expression_exception)
+
+        return [node.id for node in ast.walk(tree)
+                if isinstance(node, ast.Name)], None
+
+    @staticmethod
+    def govaluate_names(expression):
+
+        '''Tokenize expression in govaluate syntax.
+
+        Moira also accepts expressions like 't1 > 1 ? ERROR : OK'.
+        Only tokens, parentheses and ternary operators are checked,
+        full grammar is left to Moira.
+
+        Args:
+            expression (str): trigger expression.
+
+        Returns:
+            Tuple of names used in expression and syntax error or None.
+
+        '''
+
+        names = []
+        depth = 0
+        ternary = 0
+        operator = None
+        position = 0
+        end = len(expression.rstrip())
+
+        while position < end:
+
+            token = GOVALUATE_TOKEN.match(expression, position)
+            if token is None:
+                return names, 'unexpected ' + \
+                    repr(expression[position:].lstrip()[0]) + \
+                    ' at ' + str(position)
+            position = token.end()
+
+            operator = token.group('operator')
+            if token.group('name'):
+                names.append(token.group('name'))
+            elif operator == '(':
+                depth += 1
+            elif operator == ')':
+                depth -= 1
+                if depth < 0:
+                    return names, 'unbalanced \')\''
+            elif operator == '?':
+                ternary += 1
+            elif operator == ':':
+                ternary -= 1
+
+        if depth:
+            return names, 'unclosed \'(\''
+        if ternary:
+            return names, 'unmatched \'?\' and \':\''
+        if operator not in (None, ')'):
+            return names, 'unexpected end of expression'
+
+        return names, None
+
+    def expression_errors(self, expression, targets_count):
+
+        '''Check expression syntax and variables.
+
+        Args:
+            expression (str): trigger expression.
+            targets_count (int): number of trigger targets.
+
+        Returns:
+            List of errors.
+
+        '''
+
+        key = expression, targets_count
+
+        if key not in self._expressions:
+
+            errors = []
+            allowed = set(EXPRESSION_NAMES)
+            allowed.update(
+                't' + str(number) for number in range(1, targets_count + 1))
+
+            if '?' in expression:
+                names, syntax_error = self.govaluate_names(expression)
+                allowed.update(GOVALUATE_NAMES)
+            else:
+                names, syntax_error = self.python_names(expression)
+
+            if syntax_error:
+                errors.append('invalid expression: ' + syntax_error)
+            else:
+                unknown = sorted(set(names) - allowed)
+                if unknown:
+                    errors.append(
+                        'unknown names in expression: ' + ', '.join(unknown))
+
+            self._expressions[key] = errors
+
+        return self._expressions[key]
+
+    def validate(self, trigger):
+
+        '''Check trigger params.
+
+        Args:
+            trigger (dict): desired trigger params.
+
+        Returns:
+            List of errors.
+
+        '''
+
+        definition = dict(
+            (field, trigger.get(field)) for field in VALIDATED_FIELDS)
+        key = hashlib.sha1(json.dumps(
+            definition, sort_keys=True, default=sorted).encode(
+                'utf-8')).hexdigest()
+
+        if key in self._definitions:
+            return self._definitions[key]
+
+        errors = []
+        targets = definition['targets'] or []
+        expression = definition['expression']
+        warn_value = definition['warn_value']
+        error_value = definition['error_value']
+
+        if not targets:
+            errors.append('at least one target is required')
+
+        for target in targets:
+            errors.extend(self.target_errors(target))
+
+        if expression:
+            errors.extend(self.expression_errors(expression, len(targets)))
+        elif warn_value is not None and warn_value == error_value:
+            errors.append('warn_value and error_value must differ')
+
+        if definition['ttl'] is not None:
+            try:
+                if int(definition['ttl']) < 0:
+                    errors.append('ttl must not be negative')
+            except (TypeError, ValueError):
+                errors.append('ttl must be a number of seconds')
+
+        if definition['ttl_state'] not in (None,) + STATES:
+            errors.append('ttl_state must be one of ' + ', '.join(STATES))
+
+        unknown_days = sorted(
+            set(definition['disabled_days'] or ()) - set(DAYS))
+        if unknown_days:
+            errors.append('unknown disabled_days: ' + ', '.join(unknown_days))
+
+        self._definitions[key] = errors
+        return errors
+
+    def validate_all(self, triggers):
+
+        '''Check params of many triggers.
+
+        Args:
+            triggers (list): desired params of triggers.
+
+        Returns:
+            Errors by trigger names, only for invalid triggers.
+
+        '''
+
+        failed = {}
+
+        for trigger in triggers:
+            errors = self.validate(trigger)
+            if errors:
+                failed[trigger['name']] = errors
+
+        return failed
+
+
+class CircuitBreaker(object):
+
+    '''Stop calling degraded Moira API from subsequent module runs.
+
+    Breaker state is kept in a file per api url, so it is shared by
+    all tasks running on the controller. Breaker opens after 'threshold'
+    consecutive failures. When 'timeout' expires, a single task is allowed
+    to probe the API: its success closes the breaker, failure opens it again.
+    State is read and updated under a lock file, so concurrent tasks
+    neither lose failures nor probe the API together.
+
+    Attributes:
+        api_url (str): url of Moira API.
+        path (str): state file path.
+        lock_path (str): lock file path.
+        threshold (int): consecutive failures to open the breaker.
+        timeout (int): seconds to wait before probing the API.
+
+    '''
+
+    def __init__(self, cache_dir, api_url, threshold, timeout):
+
+        ensure_dir(cache_dir)
+        self.api_url = api_url
+        self.path = os.path.join(
+            cache_dir, 'breaker-' + cache_key(api_url) + '.json')
+        self.lock_path = os.path.join(
+            cache_dir, 'breaker-' + cache_key(api_url) + '.lock')
+        self.threshold = threshold
+        self.timeout = timeout
+
+    def _load(self):
+
+        '''Read breaker state, closed breaker if unavailable.'''
+
+        try:
+            with open(self.path, 'rb') as state_file:
+                return json.loads(state_file.read().decode('utf-8'))
+        except (IOError, OSError, ValueError):
+            return {'failures': 0, 'opened_at': None, 'probe_at': None}
+
+    def _save(self, state):
+
+        '''Atomically replace breaker state.'''
+
+        state_path = self.path + '.' + str(os.getpid())
+
+        try:
+            with open(state_path, 'wb') as state_file:
+                state_file.write(json.dumps(state).encode('utf-8'))
+            os.rename(state_path, self.path)
+        except (IOError, OSError):
+            pass
+
+    def blocked(self):
+
+        '''Check if API requests are allowed.
+
+        Returns:
+            Reason if breaker is open, None otherwise.
+
+        '''
+
+        with file_lock(self.lock_path):
+
+            state = self._load()
+
+            if state['opened_at'] is None:
+                return
+
+            now = time.time()
+            retry_at = max(state['opened_at'], state['probe_at'] or 0) + \
+                self.timeout
+
+            if now < retry_at:
+                return 'Circuit breaker is open for ' + self.api_url + \
+                       ' after ' + str(state['failures']) + \
+                       ' consecutive failures. Next probe in ' + \
+                       str(int(retry_at - now) + 1) + ' seconds.'
+
+            state['probe_at'] = now
+            self._save(state)
+
+    def success(self):
+
+        '''Close breaker.'''
+
+        with file_lock(self.lock_path):
+            if self._load()['failures']:
+                self._save(
+                    {'failures': 0, 'opened_at': None, 'probe_at': None})
+
+    def failure(self):
+
+        '''Count failure and open breaker if threshold is reached.'''
+
+        with file_lock(self.lock_path):
+
+            state = self._load()
+            state['failures'] += 1
+
+            if state['failures'] >= self.threshold:
+                state['opened_at'] = time.time()
+                state['probe_at'] = None
+
+            self._save(state)
+
+
+class Coordinator(object):
+
+    '''Share work between concurrent module runs on the controller.
+
+    Runs for the same api url share a trigger ids cache and lock files
+    in cache directory: the trigger list is fetched by one run per cache
+    window, triggers with the same name are created one at a time and
+    periodic tasks run once per cache window. Trigger names share
+    LOCK_BUCKETS lock files, so their number does not grow with the
+    number of triggers.
+
+    Attributes:
+        prefix (str): path prefix of cache and lock files.
+        window (int): cache lifetime in seconds.
+
+    '''
+
+    def __init__(self, cache_dir, api_url, window):
+
+        ensure_dir(cache_dir)
+        self.prefix = os.path.join(cache_dir, cache_key(api_url))
+        self.window = window
+
+    @contextmanager
+    def lock(self, name):
+
+        '''Hold exclusive file lock.
+
+        Args:
+            name (str): lock name.
+
+        '''
+
+        with file_lock(self.prefix + '-' + cache_key(name) + '.lock'):
+            yield
+
+    @contextmanager
+    def trigger_lock(self, trigger_name):
+
+        '''Hold exclusive lock of the bucket of trigger name.
+
+        Args:
+            trigger_name (str): trigger name.
+
+        '''
+
+        bucket = int(cache_key(trigger_name), 16) % LOCK_BUCKETS
+
+        with file_lock(self.prefix + '-trigger-' + str(bucket) + '.lock'):
+            yield
+
+    def _read_ids(self):
+
+        '''Read trigger ids cache, None if missing or expired.'''
+
+        try:
+            with open(self.prefix + '-triggers.json', 'rb') as cache_file:
+                cache = json.loads(cache_file.read().decode('utf-8'))
+        except (IOError, OSError, ValueError):
+            return
+
+        if time.time() - cache['fetched_at'] < self.window:
+            return cache
+
+    def _write_ids(self, cache):
+
+        '''Atomically replace trigger ids cache.'''
+
+        cache_path = self.prefix + '-triggers.json'
+        tmp_path = cache_path + '.' + str(os.getpid())
+
+        with open(tmp_path, 'wb') as cache_file:
+            cache_file.write(json.dumps(cache).encode('utf-8'))
+        os.rename(tmp_path, cache_path)
+
+    def trigger_ids(self, fetch):
+
+        '''Get trigger ids by names, fetch them once per cache window.
+
+        Args:
+            fetch (function): returns trigger ids by names or None.
+
+        Returns:
+            Trigger ids by names, None if fetch failed.
+
+        '''
+
+        with self.lock('triggers'):
+
+            cache = self._read_ids()
+
+            if cache is None:
+                fetched_at = time.time()
+                trigger_ids = fetch()
+                if trigger_ids is None:
+                    return
+                cache = {'fetched_at': fetched_at, 'ids': trigger_ids}
+                self._write_ids(cache)
+
+        return cache['ids']
+
+    def remember(self, trigger_name, trigger_id):
+
+        '''Update cached trigger id.
+
+        Args:
+            trigger_name (str): trigger name.
+            trigger_id (str): trigger id, None if trigger removed.
+
+        '''
+
+        with self.lock('triggers'):
+
+            cache = self._read_ids()
+
+            if cache is not None:
+                if trigger_id is None:
+                    cache['ids'].pop(trigger_name, None)
+                else:
+                    cache['ids'][trigger_name] = trigger_id
+                self._write_ids(cache)
+
+    def once(self, task):
+
+        '''Check if task is due in the current cache window.
+
+        Args:
+            task (str): task name.
+
+        Returns:
+            True for the first caller in cache window, False otherwise.
+
+        '''
+
+        stamp_path = self.prefix + '-' + task + '.stamp'
+
+        with self.lock(task):
+
+            try:
+                if time.time() - os.path.getmtime(stamp_path) < self.window:
+                    return False
+            except OSError:
+                pass
+
+            with open(stamp_path, 'a'):
+                os.utime(stamp_path, None)
+
+        return True
+
+
+class _SnapshotClient(object):
+
+    '''Offline replacement for moira_client api client.'''
+
+    @staticmethod
+    def get(path):
+
+        '''Every endpoint is available offline.
+
+        Args:
+            path (str): api path.
+
+        Returns:
+            Empty response.
+
+        '''
+
+        return {}
+
+
+class _SnapshotTrigger(object):
+
+    '''Trigger restored from a snapshot.
+
+    Attributes:
+        id (str): trigger id.
+
+    '''
+
+    def __init__(self, manager, **kwargs):
+
+        self._manager = manager
+        self.id = None
+        self.__dict__.update(kwargs)
+
+    def save(self):
+
+        '''Add trigger to the snapshot index.'''
+
+        if self.id is None:
+            self.id = str(uuid.uuid4())
+        self._manager.index(self)
+        return self.id
+
+    def update(self):
+
+        '''Replace trigger in the snapshot index.'''
+
+        return self.save()
+
+
+class _SnapshotTriggers(object):
+
+    '''In-memory trigger storage indexed by trigger id and name.
+
+    Name index keeps ids of triggers with the same name in the order
+    they were added, so lookups by name match a scan of fetch_all.
+
+    Attributes:
+        trigger_client (class): offline api client.
+
+    '''
+
+    def __init__(self):
+
+        self.trigger_client = _SnapshotClient()
+        self._by_id = OrderedDict()
+        self._by_name = {}
+        self._first = {}
+        self._names = {}
+
+    def _unindex_name(self, trigger_id):
+
+        '''Remove trigger id from name index.'''
+
+        name = self._names.pop(trigger_id, None)
+        if name is not None:
+            ids = self._by_name[name]
+            ids.remove(trigger_id)
+            if ids:
+                self._first[name] = ids[0]
+            else:
+                del self._by_name[name]
+                del self._first[name]
+
+    def index(self, moira_trigger):
+
+        '''Add or replace trigger.
+
+        Args:
+            moira_trigger (class): snapshot trigger.
+
+        '''
+
+        self._by_id[moira_trigger.id] = moira_trigger
+
+        if self._names.get(moira_trigger.id) != moira_trigger.name:
+            self._unindex_name(moira_trigger.id)
+            self._names[moira_trigger.id] = moira_trigger.name
+            self._by_name.setdefault(
+                moira_trigger.name, []).append(moira_trigger.id)
+            self._first.setdefault(moira_trigger.name, moira_trigger.id)
+
+    def ids_by_name(self):
+
+        '''Get ids of all triggers without scanning them.
+
+        Returns:
+            Trigger ids by trigger names, id of the first added trigger
+            for triggers with the same name. Must not be modified.
+
+        '''
+
+        return self._first
+
+    def fetch_all(self):
+
+        '''Mirror moira.trigger.fetch_all'''
+
+        return list(self._by_id.values())
+
+    def fetch_by_id(self, trigger_id):
+
+        '''Mirror moira.trigger.fetch_by_id'''
+
+        return self._by_id.get(trigger_id)
+
+    def create(self, **kwargs):
+
+        '''Mirror moira.trigger.create'''
+
+        return _SnapshotTrigger(self, **kwargs)
+
+    def delete(self, trigger_id):
+
+        '''Mirror moira.trigger.delete'''
+
+        self._unindex_name(trigger_id)
+        return self._by_id.pop(trigger_id, None) is not None
+
+
+class _SnapshotTagStats(object):
+
+    '''Tag restored from a snapshot.
+
+    Attributes:
+        name (str): tag name.
+        triggers (list): ids of triggers using the tag.
+
+    '''
+
+    def __init__(self, name, triggers):
+
+        self.name = name
+        self.triggers = triggers
+
+
+class _SnapshotTags(object):
+
+    '''In-memory tag storage.'''
+
+    def __init__(self):
+
+        self._stats = OrderedDict()
+
+    def index(self, name, triggers):
+
+        '''Add or replace tag.
+
+        Args:
+            name (str): tag name.
+            triggers (list): ids of triggers using the tag.
+
+        '''
+
+        self._stats[name] = _SnapshotTagStats(name, triggers)
+
+    def stats(self):
+
+        '''Mirror moira.tag.stats'''
+
+        return list(self._stats.values())
+
+    def delete(self, tag):
+
+        '''Mirror moira.tag.delete'''
+
+        return self._stats.pop(tag, None) is not None
+
+
+class MoiraSnapshot(object):
+
+    '''Moira api backed by a local snapshot of triggers and tags.
+
+    Snapshot is a gzipped json document with triggers stored as rows
+    of SNAPSHOT_FIELDS values.
+
+    Attributes:
+        trigger (class): trigger storage.
+        tag (class): tag storage.
+
+    '''
+
+    def __init__(self):
+
+        self.trigger = _SnapshotTriggers()
+        self.tag = _SnapshotTags()
+
+    @staticmethod
+    def dump(moira_api, path):
+
+        '''Atomically write triggers and tags of moira api to a snapshot file.
+
+        Args:
+            moira_api (class): moira api client.
+            path (str): snapshot file path.
+
+        Returns:
+            Number of exported triggers and tags.
+
+        '''
+
+        triggers = []
+        for moira_trigger in moira_api.trigger.fetch_all():
+            row = []
+            for field in SNAPSHOT_FIELDS:
+                value = getattr(moira_trigger, field, None)
+                if isinstance(value, (set, frozenset)):
+                    value = sorted(value)
+                row.append(value)
+            triggers.append(row)
+
+        tags = [[tag.name, list(tag.triggers or [])]
+                for tag in moira_api.tag.stats()]
+
+        snapshot = {
+            'version': SNAPSHOT_VERSION,
+            'created': int(time.time()),
+            'fields': SNAPSHOT_FIELDS,
+            'triggers': triggers,
+            'tags': tags}
+
+        snapshot_path = path + '.' + str(os.getpid())
+
+        # failed export must not leave a truncated snapshot
+        try:
+            with gzip.open(snapshot_path, 'wb') as snapshot_file:
+                snapshot_file.write(json.dumps(
+                    snapshot, separators=(',', ':')).encode('utf-8'))
+            os.rename(snapshot_path, path)
+        finally:
+            if os.path.exists(snapshot_path):
+                os.remove(snapshot_path)
+
+        return {'triggers': len(triggers), 'tags': len(tags)}
+
+    @classmethod
+    def load(cls, path):
+
+        '''Read snapshot file.
+
+        Args:
+            path (str): snapshot file path.
+
+        Returns:
+            MoiraSnapshot instance.
+
+        '''
+
+        with gzip.open(path, 'rb') as snapshot_file:
+            snapshot = json.loads(snapshot_file.read().decode('utf-8'))
+
+        if snapshot.get('version') != SNAPSHOT_VERSION:
+            raise ValueError(
+                'Unsupported snapshot version: ' +
+                str(snapshot.get('version')))
+
+        moira_snapshot = cls()
+        fields = snapshot['fields']
+
+        for row in snapshot['triggers']:
+            trigger = dict(zip(fields, row))
+            trigger['disabled_days'] = set(trigger.get('disabled_days') or [])
+            moira_snapshot.trigger.index(
+                moira_snapshot.trigger.create(**trigger))
+
+        for name, triggers in snapshot['tags']:
+            moira_snapshot.tag.index(name, triggers)
+
+        return moira_snapshot
+
+
+class MoiraAnsible(object):
+
+    '''Create, edit and delete Moira triggers.
+
+    Attributes:
+        moira_api (class): moira api client.
+        fetch_trigger_ids (function): returns trigger ids by names,
+            None if request failed.
+        coordinator (class): work sharing with concurrent module runs.
+        id_namespace (class): namespace uuid for trigger ids derived
+            from names, None to let Moira generate ids.
+        migrate_ids (bool): re-create triggers with ids derived from names.
+        changed (bool): actual trigger state.
+        dry_run (bool): enables check mode.
+        failed (dict): error message (if occurred).
+        success (dict): trigger state and id.
+        warnings (list): module warnings.
+
+    '''
+
+    def __init__(self,
+                 moira_api,
+                 coordinator=None,
+                 id_namespace=None,
+                 migrate_ids=False,
+                 changed=False,
+                 dry_run=False,
+                 failed=None,
+                 success=None,
+                 warnings=None):
+
+        self.moira_api = moira_api
+        # trigger storages with own name index are not scanned
+        self.fetch_trigger_ids = getattr(
+            moira_api.trigger, 'ids_by_name', self.scan_trigger_ids)
+        self.coordinator = coordinator
+        self.id_namespace = id_namespace
+        self.migrate_ids = migrate_ids and id_namespace is not None
+        self.changed = changed
+        self.dry_run = dry_run
+        failed = {}
+        self.failed = failed
+        success = {}
+        self.success = success
+        warnings = []
+        self.warnings = warnings
+
+    def exception_handler(self, occurred, component,
+                          desc='API Request Failed',
+                          level='error',
+                          trigger_name=None):
+
+        '''Handling occurred exceptions.
+
+        Args:
+            occurred (class): exception.
+            component (str): component name.
+            desc (str): description.
+            level (str): level of importance ('warn' or 'error').
+            trigger_name (str): name of the failed trigger, errors of
+                different triggers are kept apart by it.
+
+        '''
+
+        if level == 'error':
+
+            exception_body = {
+                'error': occurred.__class__.__name__,
+                'details': str(occurred)}
+
+            if trigger_name is not None:
+                self.failed.setdefault(desc, {}).setdefault(
+                    trigger_name, {})[component] = exception_body
+
+            elif desc not in self.failed:
+                self.failed[desc] = {
+                    component: exception_body}
+
+            else:
+                self.failed[desc].update({
+                    component: exception_body})
+
+        elif level == 'warn':
+
+            exception_body = (
+                component + ' warning: ' + desc +
+                ' Reason: ' + occurred.__class__.__name__)
+
+            self.warnings.append(
+                exception_body)
+
+    def api_check(self):
+
+        '''Moira API availability check.
+
+        Returns:
+            True if no exceptions occurred, False otherwise.
+
+        '''
+
+        desc = 'API Unavailable'
+        components = 'pattern', 'tag', 'trigger'
+
+        for component in components:
+
+            try:
+                self.moira_api.trigger.trigger_client.get(component)
+            except Exception as api_check_exception:
+                self.exception_handler(
+                    occurred=api_check_exception,
+                    component=component,
+                    desc=desc)
+
+        return bool(desc not in self.failed)
+
+    def tag_cleanup(self):
+
+        '''Remove unused tags.
+
+        '''
+
+        unused = set()
+
+        not_removed = 'Unable to remove unused tags. ' \
+                      'Tags can be removed on the next module execution.'
+
+        try:
+            for tag in self.moira_api.tag.stats():
+                if not tag.triggers:
+                    unused.add(self.moira_api.tag.delete(tag.name))
+            assert False not in unused
+        except Exception as tag_cleanup_exception:
+            self.exception_handler(
+                occurred=tag_cleanup_exception,
+                component='Tag Cleanup (tag.stats)',
+                desc=not_removed,
+                level='warn')
+
+    def snapshot_export(self, path):
+
+        '''Export all triggers and tags to a local snapshot.
+
+        Args:
+            path (str): snapshot file path.
+
+        '''
+
+        if self.dry_run:
+            self.changed = True
+            self.success['snapshot exported'] = {'path': path}
+            return
+
+        try:
+            exported = MoiraSnapshot.dump(self.moira_api, path)
+        except Exception as snapshot_export_exception:
+            self.exception_handler(
+                occurred=snapshot_export_exception,
+                component='Snapshot Export (trigger.fetch_all, tag.stats)')
+            return
+
+        exported.update({'path': path})
+        self.changed = True
+        self.success['snapshot exported'] = exported
+
+    def scan_trigger_ids(self):
+
+        '''Get ids of all triggers from the trigger list.
+
+        Returns:
+            Trigger ids by trigger names, None if request failed.
+
+        '''
+
+        try:
+            all_triggers = self.moira_api.trigger.fetch_all()
+        except Exception as get_trigger_id_exception:
+            self.exception_handler(
+                occurred=get_trigger_id_exception,
+                component='Get Trigger ID (trigger.fetch_all)')
+            return
+
+        trigger_ids = {}
+
+        for moira_trigger in all_triggers:
+            trigger_ids.setdefault(moira_trigger.name, moira_trigger.id)
+
+        return trigger_ids
+
+    def name_id(self, trigger_name):
+
+        '''Get trigger id derived from trigger name.
+
+        Args:
+            trigger_name (str): name of a trigger.
+
+        Returns:
+            Trigger id if enabled, None otherwise.
+
+        '''
+
+        if self.id_namespace is not None:
+            if not isinstance(trigger_name, str):
+                trigger_name = trigger_name.encode('utf-8')
+            return str(uuid.uuid5(self.id_namespace, trigger_name))
+
+    def fetch_by_name_id(self, trigger_name):
+
+        '''Get trigger by id derived from trigger name.
+
+        Args:
+            trigger_name (str): name of a trigger.
+
+        Returns:
+            Tuple of lookup status and trigger, if found.
+
+        '''
+
+        try:
+            moira_trigger = self.moira_api.trigger.fetch_by_id(
+                self.name_id(trigger_name))
+        except Exception as fetch_by_name_id_exception:
+            if not_found(fetch_by_name_id_exception):
+                return True, None
+            self.exception_handler(
+                occurred=fetch_by_name_id_exception,
+                component='Get Trigger (trigger.fetch_by_id)',
+                trigger_name=trigger_name)
+            return False, None
+
+        return True, moira_trigger
+
+    def get_trigger_id(self, trigger_name):
+
+        '''Get trigger id by trigger name.
+
+        Args:
+            trigger_name (str): name of a trigger.
+
+        Returns:
+            Trigger id if found, None otherwise.
+
+        '''
+
+        trigger_ids = None
+
+        if self.coordinator is not None:
+            try:
+                trigger_ids = self.coordinator.trigger_ids(
+                    self.fetch_trigger_ids)
+            except (IOError, OSError) as coordinator_exception:
+                self.coordination_failed(coordinator_exception)
+
+        if self.coordinator is None:
+            trigger_ids = self.fetch_trigger_ids()
+
+        if trigger_ids is not None:
+            return trigger_ids.get(trigger_name)
+
+    def trigger_update_check(self, moira_trigger, trigger):
+
+        '''Check to make sure the trigger was updated.
+
+        Args:
+            moira_trigger (class): existing Moira trigger.
+            trigger (dict): desired params for existing trigger.
+
+        '''
+
+        not_updated = {}
+
+        for parameter in trigger:
+            if not moira_trigger.__dict__[parameter] == trigger[parameter]:
+                not_updated.update({
+                    parameter: {
+                        'desired': trigger[parameter],
+                        'actual': moira_trigger.__dict__[parameter]}})
+
+        if not_updated:
+            self.failed.setdefault('failed_to_update_trigger', {})[
+                trigger['name']] = not_updated
+        else:
+            self.changed = True
+
+    def trigger_update(self, moira_trigger, trigger):
+
+        '''Updates parameters of existing trigger.
+
+        Args:
+            moira_trigger (class): existing Moira trigger.
+            trigger (dict): desired params for existing trigger.
+
+        '''
+
+        trigger_name = trigger['name']
+
+        for parameter in trigger:
+            if not moira_trigger.__dict__[parameter] == trigger[parameter]:
+                moira_trigger.__dict__[parameter] = trigger[parameter]
+
+        if not self.dry_run:
+
+            try:
+                moira_trigger.update()
+            except Exception as trigger_update_exception:
+                self.exception_handler(
+                    occurred=trigger_update_exception,
+                    component='Trigger Update (trigger.update)',
+                    trigger_name=trigger_name)
+
+            self.trigger_update_check(moira_trigger, trigger)
+
+        else:
+
+            self.changed = True
+
+        if trigger_name not in self.success:
+
+            self.success[trigger_name] = {
+                'trigger changed': moira_trigger.id}
+
+    def trigger_remove(self, trigger_name, trigger_id):
+
+        '''Remove trigger.
+
+        Args:
+            trigger_name (str): trigger name.
+            trigger_id (str): trigger id.
+
+        '''
+
+        if trigger_id is None:
+
+            self.success.update({
+                trigger_name: 'no id found for trigger'})
+
+        else:
+
+            if not self.dry_run:
+
+                try:
+                    self.moira_api.trigger.delete(trigger_id)
+                except Exception as trigger_remove_exception:
+                    self.exception_handler(
+                        occurred=trigger_remove_exception,
+                        component='Remove Trigger (trigger.delete)',
+                        trigger_name=trigger_name)
+                    return
+
+                self.trigger_remember(trigger_name, None)
+
+            self.changed = True
+            self.success[trigger_name] = {
+                'trigger removed': trigger_id}
+
+    def trigger_create(self, trigger):
+
+        '''Create new trigger object, not saved to Moira.
+
+        Trigger with id derived from its name must be saved with
+        trigger_put: moira-client Trigger.save fetches a trigger with
+        such id first and fails, as it does not exist yet.
+
+        Args:
+            trigger (dict): desired trigger params.
+
+        Returns:
+            Moira trigger.
+
+        '''
+
+        if self.id_namespace is None:
+            return self.moira_api.trigger.create(**trigger)
+
+        return self.moira_api.trigger.create(
+            id=self.name_id(trigger['name']), **trigger)
+
+    def trigger_put(self, moira_trigger, trigger, path, component):
+
+        '''Save trigger with a single request.
+
+        Unlike moira-client Trigger.save and Trigger.update, neither the
+        trigger list nor the trigger itself is fetched before saving.
+
+        Args:
+            moira_trigger (class): Moira trigger.
+            trigger (dict): desired trigger params.
+            path (str): api path, 'trigger' for new triggers.
+            component (str): component name.
+
+        Returns:
+            Trigger id, None if request failed.
+
+        '''
+
+        for parameter in trigger:
+            moira_trigger.__dict__[parameter] = trigger[parameter]
+
+        if self.dry_run:
+            return moira_trigger.id or 'gh0st'
+
+        try:
+            return self.moira_api.trigger.trigger_client.put(
+                path, json=trigger_body(moira_trigger))['id']
+        except Exception as trigger_put_exception:
+            self.exception_handler(
+                occurred=trigger_put_exception,
+                component=component,
+                trigger_name=trigger['name'])
+
+    def trigger_add(self, trigger):
+
+        '''Create new trigger with a single request.
+
+        Args:
+            trigger (dict): desired trigger params.
+
+        '''
+
+        trigger_id = self.trigger_put(
+            moira_trigger=self.trigger_create(trigger),
+            trigger=trigger,
+            path='trigger',
+            component='Trigger Add (trigger.put)')
+
+        if trigger_id is None:
+            return
+
+        if not self.dry_run:
+            self.trigger_remember(trigger['name'], trigger_id)
+
+        self.changed = True
+        self.success[trigger['name']] = {
+            'new trigger created': trigger_id}
+
+    def trigger_write(self, moira_trigger, trigger):
+
+        '''Update existing trigger with a single request.
+
+        Args:
+            moira_trigger (class): existing Moira trigger.
+            trigger (dict): desired params for existing trigger.
+
+        '''
+
+        trigger_id = self.trigger_put(
+            moira_trigger=moira_trigger,
+            trigger=trigger,
+            path='trigger/' + moira_trigger.id,
+            component='Trigger Write (trigger.put)')
+
+        if trigger_id is None:
+            return
+
+        self.changed = True
+        self.success[trigger['name']] = {
+            'trigger changed': trigger_id}
+
+    def trigger_rekey(self, trigger, trigger_id):
+
+        '''Re-create existing trigger with id derived from its name.
+
+        Args:
+            trigger (dict): desired trigger params.
+            trigger_id (str): current trigger id.
+
+        '''
+
+        new_trigger_id = self.trigger_put(
+            moira_trigger=self.trigger_create(trigger),
+            trigger=trigger,
+            path='trigger',
+            component='Trigger Re-key (trigger.put)')
+
+        if new_trigger_id is None:
+            return
+
+        if not self.dry_run:
+
+            try:
+                self.moira_api.trigger.delete(trigger_id)
+            except Exception as trigger_rekey_exception:
+                self.exception_handler(
+                    occurred=trigger_rekey_exception,
+                    component='Trigger Re-key (trigger.delete)',
+                    trigger_name=trigger['name'])
+                return
+
+            self.trigger_remember(trigger['name'], new_trigger_id)
+
+        self.changed = True
+        self.success[trigger['name']] = {
+            'trigger re-keyed': {
+                'from': trigger_id,
+                'to': new_trigger_id}}
+
+    def trigger_edit(self, trigger, trigger_id):
+
+        '''Create new or edit existing trigger.
+
+        Args:
+            trigger (dict): desired trigger params.
+            trigger_id (str): trigger id.
+
+        '''
+
+        moira_trigger = None
+
+        if trigger_id is not None:
+
+            try:
+                moira_trigger = self.moira_api.trigger.fetch_by_id(trigger_id)
+            except Exception as trigger_edit_exception:
+                if not_found(trigger_edit_exception):
+                    return self.trigger_edit(trigger, None)
+                self.exception_handler(
+                    occurred=trigger_edit_exception,
+                    component='Trigger Edit (trigger.fetch_by_id)',
+                    trigger_name=trigger['name'])
+                return
+
+        if moira_trigger is None and self.id_namespace is not None:
+            return self.trigger_add(trigger)
+
+        if moira_trigger is None:
+
+            moira_trigger = self.moira_api.trigger.create(**trigger)
+
+            if not self.dry_run:
+
+                try:
+                    moira_trigger.save()
+                except Exception as trigger_save_exception:
+                    self.exception_handler(
+                        occurred=trigger_save_exception,
+                        component='Trigger Edit (trigger.save)',
+                        trigger_name=trigger['name'])
+                    return
+
+                moira_trigger_id = moira_trigger.id
+
+                self.trigger_remember(trigger['name'], moira_trigger_id)
+
+            else:
+
+                moira_trigger_id = 'gh0st'
+
+            self.changed = True
+            self.success[trigger['name']] = {
+                'new trigger created': moira_trigger_id}
+
+        self.trigger_update(moira_trigger, trigger)
+
+    def result(self, result_format='full', result_file=None):
+
+        '''Module result in requested format.
+
+        Args:
+            result_format (str): 'full' for state and id of every trigger,
+                'summary' for number of triggers per action,
+                'file' to save full result to json lines file.
+            result_file (str): path to save full result.
+
+        Returns:
+            Module result.
+
+        '''
+
+        if result_format == 'full':
+            return self.success
+
+        actions = {}
+
+        for trigger_result in self.success.values():
+            if isinstance(trigger_result, dict):
+                for action in trigger_result:
+                    actions[action] = actions.get(action, 0) + 1
+            else:
+                actions[trigger_result] = actions.get(trigger_result, 0) + 1
+
+        summary = {
+            'total': len(self.success),
+            'actions': actions}
+
+        if result_format == 'file':
+
+            try:
+                with open(result_file, 'wb') as result_lines:
+                    for name, trigger_result in self.success.items():
+                        result_lines.write(json.dumps(
+                            {'name': name, 'result': trigger_result},
+                            separators=(',', ':')).encode('utf-8') + b'\n')
+            except Exception as result_file_exception:
+                self.exception_handler(
+                    occurred=result_file_exception,
+                    component='Result File (' + result_file + ')',
+                    desc='Unable To Save Result')
+                return
+
+            summary = {
+                'total': len(self.success),
+                'path': result_file}
+
+        return summary
+
+    def coordination_failed(self, occurred):
+
+        '''Warn about unusable cache directory and stop coordination.
+
+        Args:
+            occurred (class): exception.
+
+        '''
+
+        self.exception_handler(
+            occurred=occurred,
+            component='Coordinator (' + str(occurred) + ')',
+            desc='Unable to use cache directory, '
+                 'continuing without coordination.',
+            level='warn')
+        self.coordinator = None
+
+    def trigger_remember(self, trigger_name, trigger_id):
+
+        '''Update trigger id cached for concurrent module runs.
+
+        Args:
+            trigger_name (str): trigger name.
+            trigger_id (str): trigger id, None if trigger removed.
+
+        '''
+
+        if self.coordinator is not None:
+            try:
+                self.coordinator.remember(trigger_name, trigger_id)
+            except (IOError, OSError) as coordinator_exception:
+                self.coordination_failed(coordinator_exception)
+
+    def task_due(self, task):
+
+        '''Check if periodic task is due for this module run.
+
+        Args:
+            task (str): task name.
+
+        Returns:
+            True if task should run, False if done by another run.
+
+        '''
+
+        if self.coordinator is not None:
+            try:
+                return self.coordinator.once(task)
+            except (IOError, OSError) as coordinator_exception:
+                self.coordination_failed(coordinator_exception)
+
+        return True
+
+    @contextmanager
+    def trigger_lock(self, trigger_name):
+
+        '''Work with trigger exclusively among concurrent module runs.
+
+        Args:
+            trigger_name (str): trigger name.
+
+        '''
+
+        lock = None
+
+        if self.coordinator is not None:
+            lock = self.coordinator.trigger_lock(trigger_name)
+            try:
+                lock.__enter__()
+            except (IOError, OSError) as coordinator_exception:
+                self.coordination_failed(coordinator_exception)
+                lock = None
+
+        try:
+            yield
+        finally:
+            if lock is not None:
+                lock.__exit__(None, None, None)
+
+    def trigger_customize(self, trigger, state):
+
+        '''General function to work with triggers.
+
+        Args:
+            trigger (dict): desired trigger params.
+            state (str): desired trigger state.
+
+        '''
+
+        with self.trigger_lock(trigger['name']):
+
+            if self.id_namespace is not None:
+                found, moira_trigger = self.fetch_by_name_id(trigger['name'])
+                if not found:
+                    return
+                if moira_trigger is not None:
+                    return self.trigger_apply(trigger, state, moira_trigger)
+
+            # legacy triggers are found by name
+            current_id = self.get_trigger_id(trigger['name'])
+
+            if state == 'absent':
+                self.trigger_remove(
+                    trigger_name=trigger['name'],
+                    trigger_id=current_id)
+
+            elif state == 'present':
+                if current_id is not None and self.migrate_ids:
+                    self.trigger_rekey(trigger, current_id)
+                else:
+                    self.trigger_edit(
+                        trigger=trigger,
+                        trigger_id=current_id)
+
+    def trigger_apply(self, trigger, state, moira_trigger):
+
+        '''Bring fetched trigger to desired state.
+
+        Args:
+            trigger (dict): desired trigger params.
+            state (str): desired trigger state.
+            moira_trigger (class): existing Moira trigger.
+
+        '''
+
+        if state == 'absent':
+            self.trigger_remove(trigger['name'], moira_trigger.id)
+
+        elif self.trigger_diff(moira_trigger, trigger):
+            self.trigger_write(moira_trigger, trigger)
+
+        else:
+            self.success[trigger['name']] = {
+                'trigger unchanged': moira_trigger.id}
+
+    def triggers_customize(self, triggers, state):
+
+        '''Work with many triggers using a single trigger list request.
+
+        Unlike trigger_customize, existing triggers are taken from the
+        trigger list and are not updated if nothing has changed,
+        changed and new triggers are saved with a single request each.
+
+        Args:
+            triggers (list): desired params of triggers.
+            state (str): desired triggers state.
+
+        '''
+
+        try:
+            all_triggers = self.moira_api.trigger.fetch_all()
+        except Exception as triggers_customize_exception:
+            self.exception_handler(
+                occurred=triggers_customize_exception,
+                component='Get Triggers (trigger.fetch_all)')
+            return
+
+        existing = {}
+
+        for moira_trigger in all_triggers:
+            existing.setdefault(moira_trigger.name, moira_trigger)
+
+        for trigger in triggers:
+
+            trigger_name = trigger['name']
+            moira_trigger = existing.get(trigger_name)
+
+            if moira_trigger is None:
+                with self.trigger_lock(trigger_name):
+                    self.trigger_missing(trigger, state)
+
+            elif state == 'present' and self.migrate_ids and \
+                    moira_trigger.id != self.name_id(trigger_name):
+                with self.trigger_lock(trigger_name):
+                    self.trigger_rekey(trigger, moira_trigger.id)
+
+            else:
+                with self.trigger_lock(trigger_name):
+                    self.trigger_apply(trigger, state, moira_trigger)
+
+    def trigger_missing(self, trigger, state):
+
+        '''Bring trigger missing in the trigger list to desired state.
+
+        Args:
+            trigger (dict): desired trigger params.
+            state (str): desired trigger state.
+
+        '''
+
+        trigger_id = None
+
+        # trigger may be created by concurrent module runs
+        if self.coordinator is not None:
+            trigger_id = self.get_trigger_id(trigger['name'])
+
+        if state == 'absent':
+            self.trigger_remove(trigger['name'], trigger_id)
+        elif trigger_id is not None:
+            self.trigger_edit(trigger, trigger_id)
+        elif state == 'present':
+            self.trigger_add(trigger)
+
+    @staticmethod
+    def trigger_diff(moira_trigger, trigger):
+
+        '''Find parameters to change.
+
+        Args:
+            moira_trigger (class): existing Moira trigger.
+            trigger (dict): desired params for existing trigger.
+
+        Returns:
+            List of changed parameters.
+
+        '''
+
+        changed = []
+
+        for parameter in trigger:
+
+            actual = moira_trigger.__dict__.get(parameter)
+            desired = trigger[parameter]
+
+            if parameter == 'disabled_days':
+                actual, desired = set(actual or ()), set(desired or ())
+            elif parameter == 'ttl' and None not in (actual, desired):
+                actual, desired = str(actual), str(desired)
+
+            if actual != desired:
+                changed.append(parameter)
+
+        return changed
 
 
 def main():
@@ -494,10 +2262,58 @@ def main():
         'state': {
             'type': 'str',
             'required': True,
-            'choices': ['present', 'absent']},
+            'choices': ['present', 'absent', 'exported']},
+        'snapshot': {
+            'type': 'path',
+            'required': False},
+        'profile': {
+            'type': 'path',
+            'required': False},
+        'cache_dir': {
+            'type': 'path',
+            'required': False},
+        'breaker_threshold': {
+            'type': 'int',
+            'required': False,
+            'default': 0},
+        'breaker_timeout': {
+            'type': 'int',
+            'required': False,
+            'default': 60},
+        'cache_window': {
+            'type': 'int',
+            'required': False,
+            'default': 0},
+        'matrix': {
+            'type': 'dict',
+            'required': False},
+        'result_format': {
+            'type': 'str',
+            'required': False,
+            'default': 'full',
+            'choices': ['full', 'summary', 'file']},
+        'result_file': {
+            'type': 'path',
+            'required': False},
+        'validate': {
+            'type': 'bool',
+            'required': False,
+            'default': True},
+        'name_ids': {
+            'type': 'bool',
+            'required': False,
+            'default': False},
+        'id_namespace': {
+            'type': 'str',
+            'required': False,
+            'default': ID_NAMESPACE},
+        'migrate_ids': {
+            'type': 'bool',
+            'required': False,
+            'default': False},
         'name': {
             'type': 'str',
-            'required': True},
+            'required': False},
         'desc': {
             'type': 'str',
             'required': False,
@@ -519,7 +2335,7 @@ def main():
             'default': {}},
         'targets': {
             'type': 'list',
-            'required': True},
+            'required': False},
         'tags': {
             'type': 'list',
             'required': False,
@@ -531,10 +2347,62 @@ def main():
             'type': 'int',
             'required': False}}
 
+    required_if = [
+        ['state', 'present', ['name', 'targets']],
+        ['state', 'absent', ['name', 'targets']],
+        ['state', 'exported', ['snapshot']],
+        ['result_format', 'file', ['result_file']]]
+
     module = AnsibleModule(
         argument_spec=fields,
+        required_if=required_if,
         supports_check_mode=True)
 
+    profile = module.params['profile'] or os.environ.get(PROFILE_ENV)
+
+    if profile:
+        (failed, result), summary = profile_call(
+            profile, moira_run, module)
+        result['profile'] = summary
+    else:
+        failed, result = moira_run(module)
+
+    if not failed:
+        module.exit_json(**result)
+    else:
+        module.fail_json(**result)
+
+
+def cache_dir_failure(occurred):
+
+    '''Module result for unusable cache directory.
+
+    Args:
+        occurred (class): exception.
+
+    Returns:
+        Module result.
+
+    '''
+
+    return {'msg': {
+        'Unable to use cache directory': {
+            'error': occurred.__class__.__name__,
+            'details': str(occurred)}}}
+
+
+def moira_run(module):
+
+    '''Work with triggers according to module parameters.
+
+    Args:
+        module (class): ansible module.
+
+    Returns:
+        Tuple of failure flag and module result.
+
+    '''
+
     missing_moira_client = 'Unable to import required module. ' \
                            'Make sure you have moira-client installed: ' \
                            'pip install moira-client'
@@ -560,33 +2428,149 @@ def main():
     for parameter in trigger_parameters_dynamic:
         trigger.update({parameter: module.params[parameter]})
 
-    if not HAS_MOIRA_CLIENT:
-        module.fail_json(msg=missing_moira_client)
+    state = module.params['state']
+    triggers = [trigger]
+
+    if state != 'exported' and module.params['matrix']:
+
+        triggers = expand_triggers(trigger, module.params['matrix'])
+        names, duplicates = set(), set()
+
+        for expanded in triggers:
+            if expanded['name'] in names:
+                duplicates.add(expanded['name'])
+            names.add(expanded['name'])
+
+        if duplicates:
+            return True, {'msg': {
+                'Matrix produces triggers with same names':
+                    sorted(duplicates)}}
+
+    if state == 'present' and module.params['validate']:
+
+        invalid = TriggerValidator().validate_all(triggers)
+
+        if invalid:
+            return True, {'msg': {'Trigger Validation Failed': invalid}}
+
+    offline = bool(module.check_mode and module.params['snapshot'] and
+                   state != 'exported')
+
+    if offline:
+
+        try:
+            moira_api = MoiraSnapshot.load(module.params['snapshot'])
+        except Exception as snapshot_load_exception:
+            return True, {'msg': {
+                'Unable to load snapshot': {
+                    'error': snapshot_load_exception.__class__.__name__,
+                    'details': str(snapshot_load_exception)}}}
+
+    else:
+
+        if not HAS_MOIRA_CLIENT:
+            return True, {'msg': missing_moira_client}
+
+        moira_api = Moira(**api)
+
+    coordinator = None
+    cache_dir = os.path.expanduser(module.params['cache_dir'] or CACHE_DIR)
+
+    if not offline and module.params['cache_window'] > 0:
+
+        try:
+            coordinator = Coordinator(
+                cache_dir=cache_dir,
+                api_url=module.params['api_url'],
+                window=module.params['cache_window'])
+        except (IOError, OSError) as coordinator_exception:
+            return True, cache_dir_failure(coordinator_exception)
+
+    id_namespace = None
+
+    if module.params['name_ids']:
+
+        try:
+            id_namespace = uuid.UUID(module.params['id_namespace'])
+        except ValueError:
+            return True, {
+                'msg': 'id_namespace is not a valid uuid: ' +
+                       module.params['id_namespace']}
 
-    moira_api = Moira(**api)
     moira_ansible = MoiraAnsible(
         moira_api=moira_api,
+        coordinator=coordinator,
+        id_namespace=id_namespace,
+        migrate_ids=module.params['migrate_ids'],
         dry_run=module.check_mode)
 
-    if not moira_ansible.api_check():
-        module.fail_json(msg=moira_ansible.failed)
+    breaker = None
+
+    if not offline and module.params['breaker_threshold'] > 0:
+
+        try:
+            breaker = CircuitBreaker(
+                cache_dir=cache_dir,
+                api_url=module.params['api_url'],
+                threshold=module.params['breaker_threshold'],
+                timeout=module.params['breaker_timeout'])
+            reason = breaker.blocked()
+        except (IOError, OSError) as breaker_exception:
+            return True, cache_dir_failure(breaker_exception)
+
+        if reason:
+            return True, {'msg': reason}
+
+    api_available = offline or moira_ansible.api_check()
+
+    if breaker:
+
+        try:
+            if api_available:
+                breaker.success()
+            else:
+                breaker.failure()
+        except (IOError, OSError) as breaker_exception:
+            result = cache_dir_failure(breaker_exception)
+            result['msg'].update(moira_ansible.failed)
+            return True, result
+
+    if not api_available:
+        return True, {'msg': moira_ansible.failed}
+
+    if state == 'exported':
+        moira_ansible.snapshot_export(module.params['snapshot'])
 
-    moira_ansible.trigger_customize(
-        trigger=trigger,
-        state=module.params['state'])
+    elif module.params['matrix']:
+        moira_ansible.triggers_customize(
+            triggers=triggers,
+            state=state)
 
-    if not module.check_mode:
+    else:
+        moira_ansible.trigger_customize(
+            trigger=trigger,
+            state=state)
+
+    if not module.check_mode and state != 'exported' and \
+            moira_ansible.task_due('tag_cleanup'):
         moira_ansible.tag_cleanup()
 
+    # partial results are returned along with failures
+    result = moira_ansible.result(
+        result_format=module.params['result_format'],
+        result_file=module.params['result_file'])
+
     if not moira_ansible.failed:
-        module.exit_json(
-            changed=moira_ansible.changed,
-            result=moira_ansible.success,
-            warnings=moira_ansible.warnings)
-    else:
-        module.fail_json(
-            msg=moira_ansible.failed,
-            warnings=moira_ansible.warnings)
+        return False, {
+            'changed': moira_ansible.changed,
+            'result': result,
+            'warnings': moira_ansible.warnings}
+
+    return True, {
+        'msg': moira_ansible.failed,
+        'changed': moira_ansible.changed,
+        'result': result,
+        'warnings': moira_ansible.warnings}
 
 
 if __name__ == '__main__':